@@ -0,0 +1,60 @@
+import contextlib
+import gzip
+import os
+import secrets
+
+
+class AtomicFile:
+    def __init__(self, path: str, mode: str = 'w', encoding: str = None, compress: bool = False):
+        """
+        A file that only appears at path once it is complete. It is written under a unique temporary name in the
+        directory of path and renamed over path by commit, so readers never see a partially written file, an earlier
+        file is only replaced by a finished one, and several processes writing the same path do not interleave. When
+        used as a context manager the file is committed if the block exits cleanly and discarded otherwise.
+
+        :param path: The file to write.
+        :param mode: 'w' for text or 'wb' for binary output.
+        :param encoding: The encoding of text output.
+        :param compress: Gzip the output.
+        """
+        self.path = path
+        self.mode = mode
+        self.encoding = encoding
+        self.compress = compress
+        self.temporary_path = None
+        self.file = None
+
+    def open(self):
+        """Create the temporary file and return it opened for writing"""
+        # Unique per process and call; opened exclusively, so the name can never be shared
+        self.temporary_path = f"{self.path}.{os.getpid()}.{secrets.token_hex(4)}.tmp"
+        mode = self.mode.replace('w', 'x')
+        if self.compress:
+            self.file = gzip.open(self.temporary_path, mode if 'b' in mode else mode + 't', encoding=self.encoding)
+        else:
+            self.file = open(self.temporary_path, mode, encoding=self.encoding)
+        return self.file
+
+    def commit(self):
+        """Close the file and move it to path"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.replace(self.temporary_path, self.path)
+
+    def discard(self):
+        """Close and remove the temporary file, leaving path untouched"""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.temporary_path)
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.discard()
@@ -0,0 +1,456 @@
+import struct
+import numpy as np
+from collections import deque
+from Atomic_File import AtomicFile
+
+# Binary layout of a compiled FSM file (all values little-endian, every section starts at a multiple of 8 bytes):
+#
+#   header        64 bytes   magic b'HFSM', uint32 format version, uint32 number of states S, uint32 number of
+#                            letters K, then uint64 byte offsets of the letter table, transition array, legal next
+#                            letters masks and last letters masks, zero padded to 64 bytes
+#   letter table  K * 4      the letters in the total ordering as UTF-32 code points (dtype '<U1')
+#   transitions   S * K * 4  int32 transition table in row-major order, -1 where a letter cannot be written
+#   legal masks   S * 8      uint64 legal next letters mask of every state, bit i denotes letter i
+#   last masks    S * 8      uint64 last letters mask of every state
+#
+# The origin is state 0. Every section can be mapped with numpy.memmap, so processes share one read-only copy.
+FILE_MAGIC = b'HFSM'
+FILE_VERSION = 1
+HEADER_FORMAT = '<4sIII4Q'
+HEADER_SIZE = 64
+
+
+class CompiledFSM:
+    def __init__(self, letters: list[str], transitions: np.ndarray, legal_masks: np.ndarray, last_masks: np.ndarray):
+        """
+        A fiber product FSM compiled to integer states. State 0 is the origin, transitions[state, letter_index] is the
+        destination state (or -1 when the letter cannot be written) and every state stores its legal-next and last
+        letter components as bitmasks over letters.
+
+        :param letters: The letters of the defining graph in the total ordering; bit i of a mask denotes letters[i].
+        :param transitions: An int32 array of shape (states, letters) holding the transition table.
+        :param legal_masks: A uint64 array holding the legal next letters mask of every state.
+        :param last_masks: A uint64 array holding the last letters mask of every state.
+        """
+        if len(letters) > 64:
+            raise ValueError("a compiled FSM supports at most 64 letters")
+        self.letters = list(letters)
+        self.letter_index = {letter: i for i, letter in enumerate(self.letters)}
+        self.transitions = transitions
+        self.legal_masks = legal_masks
+        self.last_masks = last_masks
+        self.origin = 0
+        self._state_ids = None
+        self._state_tuples = None
+        self._columns = None
+        self._successors = None
+
+    @classmethod
+    def from_fsm_dict(cls, fsm_dict: dict, letters: list[str], origin: tuple[str, str]):
+        """
+        Compile a fiber product FSM dictionary (as created by FSMGenerator.generate_fiber_product_fsm_as_dict). Only the
+        states reachable from the origin are kept; they are numbered in BFS order so the origin is state 0.
+
+        :param fsm_dict: A dictionary associating every state (A, B) with a dictionary of letter -> destination state.
+        :param letters: The letters of the defining graph in the total ordering.
+        :param origin: The state of the empty word.
+        :return: The compiled FSM.
+        """
+        letter_index = {letter: i for i, letter in enumerate(letters)}
+        state_ids = {origin: 0}
+        states = [origin]
+        rows = []
+        frontier = deque([origin])
+
+        while frontier:
+            source = frontier.popleft()
+            row = [-1] * len(letters)
+            for letter, destination in fsm_dict[source].items():
+                destination = tuple(destination)
+                if destination not in state_ids:
+                    state_ids[destination] = len(states)
+                    states.append(destination)
+                    frontier.append(destination)
+                row[letter_index[letter]] = state_ids[destination]
+            rows.append(row)
+
+        def string_mask(string):
+            mask = 0
+            for letter in string:
+                mask |= 1 << letter_index[letter]
+            return mask
+
+        compiled = cls(
+            letters,
+            np.array(rows, dtype=np.int32).reshape(len(states), len(letters)),
+            np.array([string_mask(state[0]) for state in states], dtype=np.uint64),
+            np.array([string_mask(state[1]) for state in states], dtype=np.uint64)
+        )
+        compiled._state_ids = state_ids
+        return compiled
+
+    @classmethod
+    def from_mask_fsm(cls, vertices: list[tuple[int, int]], edges: list[tuple], letters: list[str]):
+        """
+        Compile a fiber product FSM given with bitmask states (as created by the reachable fiber product construction of
+        FSMGenerator), without converting the states to strings and back. States keep the order of vertices.
+
+        :param vertices: The (legal next letters, last letters) bitmask pair of every state, the origin first.
+        :param edges: (source, destination, letter) triples between vertices.
+        :param letters: The letters of the defining graph in the total ordering; bit i of a mask denotes letters[i].
+        :return: The compiled FSM.
+        """
+        letter_index = {letter: i for i, letter in enumerate(letters)}
+        state_ids = {vertex: state for state, vertex in enumerate(vertices)}
+
+        transitions = np.full((len(vertices), len(letters)), -1, dtype=np.int32)
+        for source, destination, letter in edges:
+            transitions[state_ids[source], letter_index[letter]] = state_ids[destination]
+
+        return cls(
+            letters,
+            transitions,
+            np.array([vertex[0] for vertex in vertices], dtype=np.uint64),
+            np.array([vertex[1] for vertex in vertices], dtype=np.uint64)
+        )
+
+    def save(self, path: str):
+        """
+        Write the compiled FSM to path in the binary layout documented at the top of this module. The file is written
+        under a temporary name and renamed, so readers never map a partially written file.
+
+        :param path: The file to write.
+        """
+        num_states, num_letters = self.num_states, len(self.letters)
+
+        def aligned(offset):
+            return (offset + 7) // 8 * 8
+
+        letters_offset = HEADER_SIZE
+        transitions_offset = aligned(letters_offset + 4 * num_letters)
+        legal_offset = aligned(transitions_offset + 4 * num_states * num_letters)
+        last_offset = legal_offset + 8 * num_states
+
+        sections = [
+            (letters_offset, np.array(self.letters, dtype='<U1')),
+            (transitions_offset, np.ascontiguousarray(self.transitions, dtype='<i4')),
+            (legal_offset, np.ascontiguousarray(self.legal_masks, dtype='<u8')),
+            (last_offset, np.ascontiguousarray(self.last_masks, dtype='<u8'))
+        ]
+
+        with AtomicFile(path, 'wb') as file:
+            header = struct.pack(HEADER_FORMAT, FILE_MAGIC, FILE_VERSION, num_states, num_letters,
+                                 letters_offset, transitions_offset, legal_offset, last_offset)
+            file.write(header.ljust(HEADER_SIZE, b'\0'))
+            for offset, array in sections:
+                file.write(b'\0' * (offset - file.tell()))
+                file.write(array.tobytes())
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True):
+        """
+        Load a compiled FSM written by save.
+
+        :param path: The file to read.
+        :param mmap: Map the arrays read-only with numpy.memmap instead of reading them into memory.
+        :return: The compiled FSM.
+        """
+        with open(path, 'rb') as file:
+            header = file.read(HEADER_SIZE)
+        if len(header) < HEADER_SIZE:
+            raise ValueError(f"{path} is not a compiled FSM file")
+        magic, version, num_states, num_letters, letters_offset, transitions_offset, legal_offset, last_offset = \
+            struct.unpack_from(HEADER_FORMAT, header)
+        if magic != FILE_MAGIC:
+            raise ValueError(f"{path} is not a compiled FSM file")
+        if version != FILE_VERSION:
+            raise ValueError(f"{path} has format version {version}, expected {FILE_VERSION}")
+
+        def section(dtype, offset, shape):
+            if mmap:
+                return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape)
+            return np.fromfile(path, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+        return cls(
+            section('<U1', letters_offset, (num_letters,)).tolist(),
+            section('<i4', transitions_offset, (num_states, num_letters)),
+            section('<u8', legal_offset, (num_states,)),
+            section('<u8', last_offset, (num_states,))
+        )
+
+    @property
+    def num_states(self) -> int:
+        return self.transitions.shape[0]
+
+    def mask_string(self, mask: int) -> str:
+        """Convert a bitmask to the sorted string of letters used to label FSM states"""
+        return ''.join(sorted(letter for i, letter in enumerate(self.letters) if mask >> i & 1))
+
+    def state_tuple(self, state: int) -> tuple[str, str]:
+        """Convert an integer state to the (legal next letters, last letters) string tuple of the FSM dictionary"""
+        if self._state_tuples is None:
+            self._state_tuples = [
+                (self.mask_string(legal), self.mask_string(last))
+                for legal, last in zip(self.legal_masks.tolist(), self.last_masks.tolist())
+            ]
+        return self._state_tuples[state]
+
+    def state_id(self, state_tuple: tuple[str, str]) -> int:
+        """Convert a (legal next letters, last letters) string tuple back to its integer state"""
+        if self._state_ids is None:
+            self._state_ids = {self.state_tuple(state): state for state in range(self.num_states)}
+        return self._state_ids[tuple(state_tuple)]
+
+    def to_fsm_dict(self) -> dict:
+        """Export the compiled FSM in the dictionary format of FSMGenerator.generate_fiber_product_fsm_as_dict"""
+        labels = [self.state_tuple(state) for state in range(self.num_states)]
+        fsm_dict = {}
+        for state, row in enumerate(self.transitions.tolist()):
+            fsm_dict[labels[state]] = {
+                self.letters[i]: labels[destination] for i, destination in enumerate(row) if destination >= 0
+            }
+        return fsm_dict
+
+    @property
+    def columns(self) -> dict[str, list[int]]:
+        """The transition table split by letter into plain lists, the fastest form for stepping one state at a time"""
+        if self._columns is None:
+            self._columns = {letter: self.transitions[:, i].tolist() for i, letter in enumerate(self.letters)}
+        return self._columns
+
+    @property
+    def successors(self) -> list[list[tuple[str, int]]]:
+        """
+        The outgoing transitions of every state as (letter, destination) pairs, ordered like the letters of the state's
+        legal next letters string.
+        """
+        if self._successors is None:
+            self._successors = [
+                sorted((self.letters[i], destination) for i, destination in enumerate(row) if destination >= 0)
+                for row in self.transitions.tolist()
+            ]
+        return self._successors
+
+    def step(self, state: int, letter: str) -> int:
+        destination = self.columns[letter][state]
+        if destination < 0:
+            raise KeyError(letter)
+        return destination
+
+    def locate(self, word, state: int = 0) -> int:
+        """
+        Traverse the FSM along word, one array lookup per letter.
+
+        :param word: An iterable of letters that can be constructed via traversal through the FSM.
+        :param state: The state to start the traversal from, by default the origin.
+        :return: The integer state the word ends in.
+        """
+        columns = self.columns
+        for letter in word:
+            state = columns[letter][state]
+            if state < 0:
+                raise KeyError(letter)
+        return state
+
+    def minimize(self, keep_last_letters: bool = True):
+        """
+        Merge equivalent states with Hopcroft's partition refinement. Two states are equivalent when they agree on their
+        projections and every letter leads them to equivalent states. The legal next letters projection is always kept,
+        the last letters projection only when keep_last_letters is set (otherwise the last letter masks are zeroed).
+
+        :param keep_last_letters: Whether the minimized machine must still expose the last letters of every state.
+        :return: The minimized CompiledFSM, with the origin as state 0.
+        """
+        legal_masks = self.legal_masks.tolist()
+        last_masks = self.last_masks.tolist() if keep_last_letters else [0] * self.num_states
+        outputs = list(zip(legal_masks, last_masks))
+        classes = hopcroft_minimize(self.transitions.tolist(), outputs)
+
+        # Renumber the classes in BFS order from the origin so the origin stays state 0
+        rows = self.transitions.tolist()
+        class_ids = {classes[self.origin]: 0}
+        representatives = [self.origin]
+        frontier = deque([self.origin])
+        while frontier:
+            state = frontier.popleft()
+            for destination in rows[state]:
+                if destination >= 0 and classes[destination] not in class_ids:
+                    class_ids[classes[destination]] = len(representatives)
+                    representatives.append(destination)
+                    frontier.append(destination)
+
+        transitions = [
+            [class_ids[classes[destination]] if destination >= 0 else -1 for destination in rows[state]]
+            for state in representatives
+        ]
+
+        return CompiledFSM(
+            self.letters,
+            np.array(transitions, dtype=np.int32).reshape(len(representatives), len(self.letters)),
+            np.array([legal_masks[state] for state in representatives], dtype=np.uint64),
+            np.array([last_masks[state] for state in representatives], dtype=np.uint64)
+        )
+
+
+def hopcroft_minimize(transitions: list[list[int]], outputs: list) -> list[int]:
+    """
+    Hopcroft's DFA minimization for a (possibly partial) transition table. Missing transitions (-1) are sent to an
+    implicit sink state, and states start out partitioned by their output.
+
+    :param transitions: A transition table where transitions[state][letter] is a state or -1.
+    :param outputs: A hashable output (projection) for every state; states with different outputs are never merged.
+    :return: A list associating every state with the index of its equivalence class.
+    """
+    num_states = len(transitions)
+    num_letters = len(transitions[0]) if num_states > 0 else 0
+    sink = num_states
+
+    # Predecessors of every state along every letter, including the implicit sink
+    inverse = [[[] for _ in range(num_states + 1)] for _ in range(num_letters)]
+    for state in range(num_states):
+        for letter, destination in enumerate(transitions[state]):
+            inverse[letter][destination if destination >= 0 else sink].append(state)
+    for letter in range(num_letters):
+        inverse[letter][sink].append(sink)
+
+    # Initial partition by output, the sink gets a block of its own
+    blocks_by_output = {}
+    for state in range(num_states):
+        blocks_by_output.setdefault(outputs[state], set()).add(state)
+    blocks = list(blocks_by_output.values()) + [{sink}]
+    block_of = [0] * (num_states + 1)
+    for block_id, block in enumerate(blocks):
+        for state in block:
+            block_of[state] = block_id
+
+    worklist = deque((block_id, letter) for block_id in range(len(blocks)) for letter in range(num_letters))
+
+    while worklist:
+        block_id, letter = worklist.popleft()
+
+        # All states that move into the splitter block along letter, grouped by their current block
+        touched = {}
+        for state in blocks[block_id]:
+            for predecessor in inverse[letter][state]:
+                touched.setdefault(block_of[predecessor], set()).add(predecessor)
+
+        for touched_id, inside in touched.items():
+            if len(inside) == len(blocks[touched_id]):
+                continue
+
+            # Split the block; the smaller half becomes the new block
+            outside = blocks[touched_id] - inside
+            small, large = (inside, outside) if len(inside) <= len(outside) else (outside, inside)
+            blocks[touched_id] = large
+            new_id = len(blocks)
+            blocks.append(small)
+            for state in small:
+                block_of[state] = new_id
+
+            # The old block keeps its id, so a pending splitter for it now covers the larger half only. Queue the
+            # smaller half under every letter; that is enough when the old block was already processed as well
+            for split_letter in range(num_letters):
+                worklist.append((new_id, split_letter))
+
+    return block_of[:num_states]
+
+
+class RayProductFSM(CompiledFSM):
+    def __init__(self, letters: list[str], transitions: np.ndarray, legal_masks: np.ndarray, last_masks: np.ndarray,
+                 fiber_states: np.ndarray, ray_legal_masks: np.ndarray, ray_last_masks: np.ndarray):
+        """
+        The fiber product FSM extended to follow a word w together with the ray prefixed words ray[0]w and ray[1]w. A
+        state is a fiber product state paired with the letters near the ray that commute with all of w, which is all
+        that is needed to derive the states of the prefixed words:
+
+            F(xw) = F(w) | (F({x}) & C(w))        L(xw) = L(w) | ({x} & C(w))
+
+        So a single traversal (or the state carried from the parent word) gives all three states. legal_masks and
+        last_masks describe w itself, as in a CompiledFSM.
+
+        :param fiber_states: An int32 array holding the fiber product state of w for every state.
+        :param ray_legal_masks: A uint64 array of shape (states, 2) holding the legal next letters masks of ray[0]w and ray[1]w.
+        :param ray_last_masks: A uint64 array of shape (states, 2) holding the last letters masks of ray[0]w and ray[1]w.
+        """
+        super().__init__(letters, transitions, legal_masks, last_masks)
+        self.fiber_states = fiber_states
+        self.ray_legal_masks = ray_legal_masks
+        self.ray_last_masks = ray_last_masks
+        self._ray_last_lists = None
+
+    @classmethod
+    def from_fiber_product(cls, fiber_fsm: CompiledFSM, letter_masks, ray: list[str]):
+        """
+        Build the ray aware product of a compiled fiber product FSM with a BFS from the origin; states are numbered in
+        BFS order so the origin is state 0.
+
+        :param fiber_fsm: The compiled fiber product FSM.
+        :param letter_masks: The BitmaskAlphabet of the defining graph.
+        :param ray: A list representing our ray of alternating letters (typically 'a' and 'c').
+        :return: The RayProductFSM.
+        """
+        full_mask = letter_masks.full_mask
+        first_forbidden = [letter_masks.first_forbidden[letter] for letter in ray]
+        ray_bits = [letter_masks.bit[letter] for letter in ray]
+        # Only the commuting letters that can affect a prefixed state are tracked
+        tracked = first_forbidden[0] | first_forbidden[1]
+        neighborhoods = [letter_masks.neighborhood[letter] & tracked for letter in fiber_fsm.letters]
+
+        fiber_rows = fiber_fsm.transitions.tolist()
+        fiber_legal = fiber_fsm.legal_masks.tolist()
+        fiber_last = fiber_fsm.last_masks.tolist()
+
+        origin = (fiber_fsm.origin, tracked)
+        state_ids = {origin: 0}
+        states = [origin]
+        rows = []
+        frontier = deque([origin])
+
+        while frontier:
+            fiber_state, commuting = frontier.popleft()
+            row = [-1] * len(fiber_fsm.letters)
+            for i, destination in enumerate(fiber_rows[fiber_state]):
+                if destination < 0:
+                    continue
+                product_destination = (destination, commuting & neighborhoods[i])
+                if product_destination not in state_ids:
+                    state_ids[product_destination] = len(states)
+                    states.append(product_destination)
+                    frontier.append(product_destination)
+                row[i] = state_ids[product_destination]
+            rows.append(row)
+
+        ray_legal_masks = []
+        ray_last_masks = []
+        for fiber_state, commuting in states:
+            forbidden = full_mask & ~fiber_legal[fiber_state]
+            ray_legal_masks.append([full_mask & ~(forbidden | (first_forbidden[i] & commuting)) for i in range(2)])
+            ray_last_masks.append([fiber_last[fiber_state] | (ray_bits[i] & commuting) for i in range(2)])
+
+        return cls(
+            fiber_fsm.letters,
+            np.array(rows, dtype=np.int32).reshape(len(states), len(fiber_fsm.letters)),
+            np.array([fiber_legal[fiber_state] for fiber_state, _ in states], dtype=np.uint64),
+            np.array([fiber_last[fiber_state] for fiber_state, _ in states], dtype=np.uint64),
+            np.array([fiber_state for fiber_state, _ in states], dtype=np.int32),
+            np.array(ray_legal_masks, dtype=np.uint64).reshape(len(states), 2),
+            np.array(ray_last_masks, dtype=np.uint64).reshape(len(states), 2)
+        )
+
+    @property
+    def ray_last_lists(self) -> list[tuple[int, int, int]]:
+        """(L(w), L(ray[0]w), L(ray[1]w)) of every state as plain integers, the fastest form for lookups"""
+        if self._ray_last_lists is None:
+            self._ray_last_lists = [
+                (last, ray_last[0], ray_last[1])
+                for last, ray_last in zip(self.last_masks.tolist(), self.ray_last_masks.tolist())
+            ]
+        return self._ray_last_lists
+
+    def ray_state_tuples(self, state: int) -> tuple[tuple[str, str], tuple[str, str], tuple[str, str]]:
+        """The fiber product FSM states of w, ray[0]w and ray[1]w as (legal next letters, last letters) string tuples"""
+        prefixed = tuple(
+            (self.mask_string(int(self.ray_legal_masks[state, i])), self.mask_string(int(self.ray_last_masks[state, i])))
+            for i in range(2)
+        )
+        return (self.state_tuple(state),) + prefixed
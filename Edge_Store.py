@@ -0,0 +1,97 @@
+class EdgeStore:
+    def __init__(self):
+        """
+        A set of undirected edges between named vertices. Vertex names are numbered on first sight and every edge is
+        canonicalized to an integer pair (smaller id, larger id) on insertion, so an edge found from both of its
+        endpoints, or several times from one of them, is stored once. The number of raw adjacencies that collapsed into
+        each edge is kept as its multiplicity; self-loops are rejected.
+        """
+        self.node_ids = {}
+        self.nodes = []
+        # Canonical (u, v) id pair -> multiplicity, in order of first insertion
+        self.multiplicity = {}
+        self.number_of_raw_edges = 0
+        self.number_of_self_loops = 0
+
+    def node_id(self, u: str) -> int:
+        if u not in self.node_ids:
+            self.node_ids[u] = len(self.nodes)
+            self.nodes.append(u)
+        return self.node_ids[u]
+
+    def add_edge(self, u: str, v: str) -> bool:
+        """
+        Insert an undirected edge.
+
+        :return: Whether the edge is new (False for duplicates and self-loops).
+        """
+        self.number_of_raw_edges += 1
+        u_id, v_id = self.node_id(u), self.node_id(v)
+        if u_id == v_id:
+            self.number_of_self_loops += 1
+            return False
+
+        key = (u_id, v_id) if u_id < v_id else (v_id, u_id)
+        count = self.multiplicity.get(key, 0)
+        self.multiplicity[key] = count + 1
+        return count == 0
+
+    def __len__(self):
+        return len(self.multiplicity)
+
+    def __contains__(self, edge) -> bool:
+        u, v = edge
+        if u not in self.node_ids or v not in self.node_ids:
+            return False
+        u_id, v_id = self.node_ids[u], self.node_ids[v]
+        return ((u_id, v_id) if u_id < v_id else (v_id, u_id)) in self.multiplicity
+
+    def edges(self) -> list[tuple[str, str]]:
+        """Every unique edge once, as a pair of vertex names, in order of first insertion"""
+        nodes = self.nodes
+        return [(nodes[u], nodes[v]) for u, v in self.multiplicity]
+
+    def edge_multiplicities(self) -> list[tuple[str, str, int]]:
+        """Every unique edge with the number of raw adjacencies that collapsed into it"""
+        nodes = self.nodes
+        return [(nodes[u], nodes[v], count) for (u, v), count in self.multiplicity.items()]
+
+    @property
+    def number_of_duplicates(self) -> int:
+        return self.number_of_raw_edges - self.number_of_self_loops - len(self.multiplicity)
+
+
+class EdgeWindow:
+    def __init__(self):
+        """
+        Deduplication for edges that arrive roughly level by level, as when the horosphere is streamed. Every edge is
+        put in canonical order, shorter (then smaller) vertex first, and remembered under the length of its longer
+        vertex. An edge joins vertices whose lengths differ by at most one, so once every vertex up to some length has
+        been processed the edges whose longer vertex is at most that long cannot come up again and can be forgotten.
+        """
+        # Canonical (u, v) pairs seen so far, keyed by len(v)
+        self.seen_edges = {}
+
+    @staticmethod
+    def canonical_edge(u: str, v: str) -> tuple[str, str]:
+        return (v, u) if (len(v), v) < (len(u), u) else (u, v)
+
+    def add_edge(self, u: str, v: str):
+        """
+        Insert an undirected edge.
+
+        :return: The edge in canonical order if it is new, None for duplicates and self-loops.
+        """
+        if u == v:
+            return None
+        u, v = self.canonical_edge(u, v)
+        seen = self.seen_edges.setdefault(len(v), set())
+        if (u, v) in seen:
+            return None
+        seen.add((u, v))
+        return u, v
+
+    def forget(self, longest: int):
+        """Drop the edges whose longer vertex has at most the given length"""
+        for length in [length for length in self.seen_edges if length <= longest]:
+            del self.seen_edges[length]
@@ -0,0 +1,101 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import struct
+from Compiled_FSM import CompiledFSM
+
+# Bump whenever the layout of a cache entry or the construction of a machine changes; older entries are then ignored
+CACHE_VERSION = 2
+
+MACHINE_NAMES = ('short_lex', 'last_letter', 'fiber_product')
+
+
+class FSMCache:
+    def __init__(self, cache_dir: str = '.fsm_cache', max_bytes: int = 256 * 2 ** 20):
+        """
+        A content-addressed on-disk cache of compiled automata. Entries are keyed by a hash of the canonicalized defining
+        graph, so every process working on the same graph shares one copy of the shortlex, last letter and fiber product
+        machines. An entry is a directory named by the hash holding one file per machine in the binary format of
+        CompiledFSM.save; loaded machines are memory-mapped read-only, so processes share the pages instead of each
+        reading its own copy.
+
+        :param cache_dir: The directory the cache files are written to.
+        :param max_bytes: Upper bound on the total size of the cache; least recently used entries are evicted first.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(commutation_dict: dict[str, set], order_dict: dict[str, int]) -> str:
+        """Hash of the canonical form of a defining graph (sorted neighborhoods, sorted keys) and the cache version"""
+        canonical = json.dumps({
+            'version': CACHE_VERSION,
+            'c_map': {letter: sorted(neighbors) for letter, neighbors in commutation_dict.items()},
+            'o_map': order_dict
+        }, sort_keys=True)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def path(self, commutation_dict: dict[str, set], order_dict: dict[str, int]) -> str:
+        """The directory of the cache entry of a defining graph"""
+        return os.path.join(self.cache_dir, self.key(commutation_dict, order_dict))
+
+    def load(self, commutation_dict: dict[str, set], order_dict: dict[str, int]):
+        """
+        Look up the compiled machines of a defining graph.
+
+        :return: dictionary of CompiledFSM under the keys 'short_lex', 'last_letter' and 'fiber_product', or None on a miss.
+        """
+        path = self.path(commutation_dict, order_dict)
+        if not os.path.isdir(path):
+            return None
+
+        try:
+            machines = {name: CompiledFSM.load(os.path.join(path, f"{name}.hfsm")) for name in MACHINE_NAMES}
+        except FileNotFoundError:
+            # Another process is still storing the entry or has evicted it
+            return None
+        except (OSError, ValueError, struct.error):
+            # A damaged entry is treated as a miss and rebuilt
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        # Mark the entry as recently used for the eviction policy
+        with contextlib.suppress(FileNotFoundError):
+            os.utime(path)
+        return machines
+
+    def store(self, commutation_dict: dict[str, set], order_dict: dict[str, int], machines: dict[str, CompiledFSM]):
+        """
+        Write the compiled machines of a defining graph to the cache. Every machine file is written atomically, so
+        concurrent readers never observe a partial file; an entry whose files are not all there yet is a miss.
+        """
+        path = self.path(commutation_dict, order_dict)
+        os.makedirs(path, exist_ok=True)
+        for name in MACHINE_NAMES:
+            machines[name].save(os.path.join(path, f"{name}.hfsm"))
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits within max_bytes"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            # Entries may be evicted by another process while the directory is scanned
+            try:
+                if not os.path.isdir(path):
+                    continue
+                size = sum(os.path.getsize(os.path.join(path, file_name)) for file_name in os.listdir(path))
+                entries.append((os.stat(path).st_mtime, size, path))
+            except FileNotFoundError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        # The most recently used entry is always kept
+        for _, size, path in sorted(entries)[:-1]:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
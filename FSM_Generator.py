@@ -1,23 +1,30 @@
-from word import Word, WordGenerator
+from word import WordGenerator
+from Compiled_FSM import CompiledFSM
+from FSM_Cache import FSMCache
 import networkx as nx
+import numpy as np
 import matplotlib.pyplot as plt
 from itertools import product
 import json
+from collections import deque
 
 
 class FSMGenerator:
-    def __init__(self, commutation_dict: dict[str, set], order_dict: dict[str, int]):
+    def __init__(self, commutation_dict: dict[str, set], order_dict: dict[str, int], cache: FSMCache = None):
         """
         Initialize a Finite State Machine (FSM) Generator Object. Using the defining graph of a right-angled coxeter
         group, the necessary short-lex, last-letter, and fiber-product machines can be created.
 
         :param commutation_dict: A dictionary representation of a defining graph. A letter (key) is associated with a list of letters (value) in the dictionary such that all letters in the list commute with the key
         :param order_dict: A dictionary representation of a total ordering on the letter in the defining graph. A letter (key) is associated with an index (value) that represents that letters relative position in the ordering.
+        :param cache: An optional on-disk cache the compiled machines are loaded from and stored to.
         """
         self.c_map = commutation_dict
         self.o_map = order_dict
+        self.cache = cache
         self.alphabet = set().union(letter for letter in self.o_map)
         self.language = WordGenerator(self.c_map, self.o_map)
+        self.letter_masks = self.language.letter_masks
 
     def __format_directed_edge(self, edge: tuple[set, set, str]) -> list:
         """Convert a directed edge (of length 3) to a tuple of 3 strings"""
@@ -36,16 +43,18 @@ class FSMGenerator:
 
         :return: dictionary of lists; The dictionary contains the list of vertices and edges in the shortlex machine.
         """
-        origin = self.alphabet
+        masks = self.letter_masks
+        origin = masks.full_mask
         vertices = [origin]
+        visited = {origin}
         edges = []
-        frontier = []
+        frontier = deque()
 
         # Initialize the frontier with the legal next letters for single letter words 
-        for letter in self.alphabet:
+        for letter in masks.letters:
 
             # Set destination as the set of legal next letters for each letter
-            destination = Word(letter, self.c_map, self.o_map).legal_next_letters()
+            destination = masks.legal_next_letters_step(origin, letter)
 
             frontier.append(destination)
 
@@ -54,24 +63,28 @@ class FSMGenerator:
 
         # Run BFS until we have finished the machine
         while len(frontier) > 0:
-            source = frontier.pop(0)
+            source = frontier.popleft()
 
             # We have already considered source and all its outgoing edges, we can skip it
-            if source in vertices:
+            if source in visited:
                 continue
+            visited.add(source)
             vertices.append(source)
 
             # Record outgoing edges (i.e. possible next letters) from source, this is guaranteed to be unique by above if-statement
-            for edge in source:
-                # We derived this formula to find the possible next letters given the source and the edge out
-                destination = Word(edge, self.c_map, self.o_map).forbidden_letters()\
-                    .union(self.alphabet.copy().difference(source).intersection(set(self.c_map[edge])))
-                destination = self.alphabet.copy().difference(destination)
+            for edge in masks.letters_of(source):
+                # We derived this formula to find the possible next letters given the source and the edge out:
+                # the forbidden letters of the edge together with the forbidden letters of source that commute with it
+                destination = masks.legal_next_letters_step(source, edge)
                 
                 # Add "destination", the destination vertex, to our frontier to ensure all vertices are reached
                 frontier.append(destination)
                 edges.append((source, destination, edge))
 
+        # Vertices are computed as bitmasks, convert them back to letter sets
+        vertices = [masks.letters_of(vertex) for vertex in vertices]
+        edges = [(masks.letters_of(source), masks.letters_of(destination), edge) for source, destination, edge in edges]
+
         print(f"ShortLex Machine Completed: Graph with \n\t\t{len(vertices)} Vertices and \n\t\t{len(edges)} Edges.")
 
         return {'vertices': vertices, 'edges': edges}
@@ -83,37 +96,85 @@ class FSMGenerator:
 
         :return: dictionary of lists; The dictionary contains the list of vertices and edges in the last letter machine.
         """
+        masks = self.letter_masks
         origin = ''
         vertices = []
+        visited = set()
         edges = []
-        frontier = []
+        frontier = deque()
 
         # Initialize the frontier (similar to the ShortLex machine) with possible last letters for single letter words
-        for letter in self.alphabet:
-            destination = Word(letter, self.c_map, self.o_map).last_letters()
-            edges.append((origin, destination, letter))
-            frontier.append(set(letter))
+        for letter in masks.letters:
+            destination = masks.bit[letter]
+            edges.append((origin, masks.letters_of(destination), letter))
+            frontier.append(destination)
 
         while len(frontier) > 0:
-            source = frontier.pop(0)
+            source = frontier.popleft()
 
             # We have already considered v and all its outgoing edges, we can skip its consideration
-            if source in vertices:
+            if source in visited:
                 continue
+            visited.add(source)
             vertices.append(source)
 
             # Record outgoing edges from v, this is guaranteed to be unique by above if-statement
             # Add the destination vertex, u, to our frontier to ensure all vertices are reached
-            for edge in self.alphabet.copy().difference(source):
+            for edge in masks.letters_of(masks.full_mask & ~source):
                 # We derived this formula to find the possible last letters given the source and the edge out
-                destination = set(edge).union(source.intersection(self.c_map[edge]))
+                destination = masks.last_letters_step(source, edge)
                 frontier.append(destination)
-                edges.append((source, destination, edge))
+                edges.append((masks.letters_of(source), masks.letters_of(destination), edge))
+
+        vertices = [masks.letters_of(vertex) for vertex in vertices]
 
         print(f"Last Letter Machine Completed: Graph with \n\t\t{len(vertices)} Vertices and \n\t\t{len(edges)} Edges.")
 
         return {'vertices': vertices, 'edges': edges}
 
+    def __generate_fiber_product_vertices_edges(self) -> dict[str, list]:
+        """
+        Generate the fiber product of the shortlex and last letter machines on the fly. Starting from the origin pair
+        (alphabet, ''), only product states that are reachable by writing a shortlex word are expanded, instead of
+        pairing every edge of both machines.
+
+        :return: dictionary of lists; The dictionary contains the list of vertices and edges in the fiber product machine. Vertices are pairs of (legal next letters, last letters) bitmasks, the origin comes first.
+        """
+        masks = self.letter_masks
+        origin = (masks.full_mask, 0)
+        vertices = [origin]
+        visited = {origin}
+        edges = []
+        frontier = deque([origin])
+
+        while len(frontier) > 0:
+            source = frontier.popleft()
+            legal_mask, last_mask = source
+
+            # Last letters are never legal next letters, so every legal letter is an edge of both machines
+            for edge in masks.letters_of(legal_mask):
+                destination = (masks.legal_next_letters_step(legal_mask, edge), masks.last_letters_step(last_mask, edge))
+                edges.append((source, destination, edge))
+
+                if destination not in visited:
+                    visited.add(destination)
+                    vertices.append(destination)
+                    frontier.append(destination)
+
+        print(f"Reachable Fiber Product Machine Completed: Graph with \n\t\t{len(vertices)} Reachable Vertices and "
+              f"\n\t\t{len(edges)} Edges.")
+
+        return {'vertices': vertices, 'edges': edges}
+
+    def count_theoretical_fiber_product_states(self) -> int:
+        """
+        The number of states of the full product of the shortlex and last letter machines, for comparison with the
+        reachable fiber product. Both machines are built for this, so it is only computed on demand.
+        """
+        # The last letter machine additionally has its origin ''
+        return len(self.__generate_short_lex_vertices_edges()['vertices']) \
+            * (len(self.__generate_last_letter_vertices_edges()['vertices']) + 1)
+
     def generate_short_lex_fsm_as_networkx(self) -> nx.DiGraph:
         # Generate the short-lex FSM as a dictionary of vertices and edges
         # We use the output of "__generate_short_lex_vertices_edges", which gives a list of vertices and edges
@@ -161,32 +222,54 @@ class FSMGenerator:
         print(f"Last Letter Product Machine Completed: Graph \n\t\t{len(G)}")
         return G
 
-    def generate_fiber_product_fsm_as_networkx(self) -> nx.DiGraph:
+    def generate_fiber_product_fsm_as_networkx(self, reachable_only: bool = False) -> nx.DiGraph:
         """
         Create a fiber product of our shortlex and last_letter FSM to starte generating 
         adjacent words on the horosphere.
+
+        :param reachable_only: Only keep the product states reachable from the origin (alphabet, '').
         """
+        if reachable_only:
+            fsm = self.__generate_fiber_product_vertices_edges()
+            string_of = self.letter_masks.string_of
+
+            # Associate each edge (key) with a dictionary containing its label (value)
+            labeled_edges = {
+                ((string_of(source[0]), string_of(source[1])), (string_of(destination[0]), string_of(destination[1]))):
+                    {'label': edge} for source, destination, edge in fsm['edges']
+            }
+
+            fiber_graph = nx.DiGraph()
+            fiber_graph.add_node((string_of(fsm['vertices'][0][0]), ''))
+            fiber_graph.add_edges_from(labeled_edges)
+            nx.set_edge_attributes(fiber_graph, labeled_edges)
+
+            print(f"Fiber Product Machine Completed: \n\t\t{fiber_graph}")
+
+            return fiber_graph
+
         shortlex_fsm = self.__generate_short_lex_vertices_edges()
         last_letter_fsm = self.__generate_last_letter_vertices_edges()
 
         fiber_graph = nx.DiGraph() 
 
         labeled_edges = {}
-        
-        # Iterate over all edges in both graphs and add edges in the fiber product graph
+
+        # Format every last letter edge once and group the edges by their label
+        last_letter_edges_by_label = {}
+        for last_letter_edge in last_letter_fsm['edges']:
+            last_letter_formatted = self.__format_directed_edge(last_letter_edge)
+            last_letter_edges_by_label.setdefault(last_letter_formatted[2], []).append(last_letter_formatted)
+
+        # Join every shortlex edge with the last letter edges that have the same label
         for shortlex_edge in shortlex_fsm['edges']:
-            for last_letter_edge in last_letter_fsm['edges']:
-                # Format edges for comparison
-                shortlex_formatted = self.__format_directed_edge(shortlex_edge)
-                last_letter_formatted = self.__format_directed_edge(last_letter_edge)
-                
-                # Check if edges have the same label
-                if shortlex_formatted[2] == last_letter_formatted[2]:
+            shortlex_formatted = self.__format_directed_edge(shortlex_edge)
+
+            for last_letter_formatted in last_letter_edges_by_label.get(shortlex_formatted[2], []):
+                # Add the connection to the graph with the same label
+                labeled_edges[(shortlex_formatted[0], last_letter_formatted[0]),\
+                              (shortlex_formatted[1], last_letter_formatted[1])] = {'label': shortlex_formatted[2]}
 
-                    # If they do, add the connection to the graph with the same label
-                    labeled_edges[(shortlex_formatted[0], last_letter_formatted[0]),\
-                                  (shortlex_formatted[1], last_letter_formatted[1])] = {'label': shortlex_formatted[2]}
-                    
         fiber_graph.add_edges_from(labeled_edges)
         
         # Assigns the labels we created to our graph
@@ -211,21 +294,195 @@ class FSMGenerator:
         """
         fsm_dict = {}
 
-        adj = self.generate_fiber_product_fsm_as_adj()
-        
-        # Iterate over all vertices (source) and the list of their adjacent vertices (adj_list)
-        for source, adj_list in adj.items():
-            fsm_dict[source] = {}
+        # Only the states reachable from the origin are ever visited by a traversal
+        fsm = self.__generate_fiber_product_vertices_edges()
+        string_of = self.letter_masks.string_of
 
-            # Each vertex is associated to a dictionary with keys that are possible outgoing edges in the fiber product graph.
-            # The values are the destination if you travel along that edge.
-            for desination in adj_list:
-                fsm_dict[source][adj_list[desination]['label']] = tuple(desination)
+        # Each vertex is associated to a dictionary with keys that are possible outgoing edges in the fiber product graph.
+        # The values are the destination if you travel along that edge.
+        for vertex in fsm['vertices']:
+            fsm_dict[(string_of(vertex[0]), string_of(vertex[1]))] = {}
+        for source, destination, edge in fsm['edges']:
+            fsm_dict[(string_of(source[0]), string_of(source[1]))][edge] = \
+                (string_of(destination[0]), string_of(destination[1]))
 
         self.fsm_dict = fsm_dict
 
         return fsm_dict
 
+    def compile_fiber_product_fsm(self) -> CompiledFSM:
+        """
+        Compiles the fiber product to integer states with a dense transition table, so that every step of a traversal
+        is a single array lookup.
+        """
+        if hasattr(self, 'fsm_dict'):
+            origin = (''.join(sorted(self.alphabet)), '')
+            self.compiled_fsm = CompiledFSM.from_fsm_dict(self.fsm_dict, self.letter_masks.letters, origin)
+        else:
+            # The reachable construction already works on bitmasks, so its states are compiled as they are
+            fsm = self.__generate_fiber_product_vertices_edges()
+            self.compiled_fsm = CompiledFSM.from_mask_fsm(fsm['vertices'], fsm['edges'], self.letter_masks.letters)
+
+        print(f"Fiber Product Machine Compiled: \n\t\t{self.compiled_fsm.num_states} States")
+
+        return self.compiled_fsm
+
+    def save_compiled_fsm(self, path: str):
+        """
+        Write the compiled fiber product to path in the binary format of CompiledFSM.save. The file can be loaded with
+        CompiledFSM.load and memory-mapped by any number of processes.
+        """
+        if not hasattr(self, 'compiled_fsm'):
+            self.compile_fiber_product_fsm()
+        self.compiled_fsm.save(path)
+
+    def compile_short_lex_fsm(self) -> CompiledFSM:
+        """
+        Compiles the shortlex machine to integer states. Every state only carries its legal next letters.
+        """
+        fsm = self.__generate_short_lex_vertices_edges()
+        fsm_dict = {(''.join(sorted(vertex)), ''): {} for vertex in fsm['vertices']}
+        for source, destination, edge in fsm['edges']:
+            fsm_dict[(''.join(sorted(source)), '')][edge] = (''.join(sorted(destination)), '')
+
+        return CompiledFSM.from_fsm_dict(fsm_dict, self.letter_masks.letters, (''.join(sorted(self.alphabet)), ''))
+
+    def compile_last_letter_fsm(self) -> CompiledFSM:
+        """
+        Compiles the last letter machine to integer states. Every letter that is not a last letter can be written, so
+        the legal next letters of a state are the complement of its last letters.
+        """
+        fsm = self.__generate_last_letter_vertices_edges()
+
+        def state_of(last_letters):
+            return ''.join(sorted(self.alphabet.difference(last_letters))), ''.join(sorted(last_letters))
+
+        fsm_dict = {state_of(vertex): {} for vertex in [set()] + fsm['vertices']}
+        for source, destination, edge in fsm['edges']:
+            fsm_dict[state_of(source)][edge] = state_of(destination)
+
+        return CompiledFSM.from_fsm_dict(fsm_dict, self.letter_masks.letters, state_of(set()))
+
+    def compiled_machines(self) -> dict[str, CompiledFSM]:
+        """
+        Compiles the shortlex, last letter and fiber product machines, or loads them from the cache when this defining
+        graph has been compiled before.
+
+        :return: dictionary of the compiled machines under the keys 'short_lex', 'last_letter' and 'fiber_product'.
+        """
+        machines = self.cache.load(self.c_map, self.o_map) if self.cache is not None else None
+
+        if machines is None:
+            machines = {
+                'short_lex': self.compile_short_lex_fsm(),
+                'last_letter': self.compile_last_letter_fsm(),
+                'fiber_product': self.compile_fiber_product_fsm()
+            }
+            if self.cache is not None:
+                self.cache.store(self.c_map, self.o_map, machines)
+        else:
+            print(f"Compiled Machines Loaded From Cache: \n\t\t{self.cache.path(self.c_map, self.o_map)}")
+
+        self.compiled_fsm = machines['fiber_product']
+        return machines
+
+    def minimize_fsms(self) -> dict[str, CompiledFSM]:
+        """
+        Minimizes the compiled shortlex, last letter and fiber product machines. The minimized fiber product still
+        exposes the (legal next letters, last letters) projections of every state.
+
+        :return: dictionary of the minimized machines under the keys 'short_lex', 'last_letter' and 'fiber_product'.
+        """
+        machines = self.compiled_machines()
+
+        minimized = {}
+        for name, machine in machines.items():
+            minimized[name] = machine.minimize()
+            print(f"Minimized {name} Machine: \n\t\t{machine.num_states} States -> {minimized[name].num_states} States")
+
+        return minimized
+
+    def growth_series(self, n: int) -> list[int]:
+        """
+        Counts the shortlex words of every length up to n without materializing them, by pushing word counts through the
+        compiled shortlex machine with Python integers.
+
+        :param n: The longest word length to count.
+        :return: A list whose i-th entry is the number of shortlex words (group elements) of length i.
+        """
+        rows = self.compile_short_lex_fsm().transitions.tolist()
+
+        # counts[state] is the number of words of the current length that end in state
+        counts = [0] * len(rows)
+        counts[0] = 1
+        series = [1]
+
+        for _ in range(n):
+            next_counts = [0] * len(rows)
+            for state, count in enumerate(counts):
+                if count == 0:
+                    continue
+                for destination in rows[state]:
+                    if destination >= 0:
+                        next_counts[destination] += count
+            counts = next_counts
+            series.append(sum(counts))
+
+        return series
+
+    def growth_function(self) -> tuple[list[int], list[int]]:
+        """
+        The rational growth function of the right-angled coxeter group. With c_k the number of k-cliques of the defining
+        graph (c_0 = 1) and d the size of the largest clique, the growth series is
+
+            W(t) = 1 / sum_k c_k (-t / (1 + t))^k = (1 + t)^d / sum_k c_k (-t)^k (1 + t)^(d - k)
+
+        :return: The (numerator, denominator) polynomials as lists of integer coefficients, lowest degree first.
+        """
+        defining_graph = nx.Graph()
+        defining_graph.add_nodes_from(self.alphabet)
+        defining_graph.add_edges_from((letter, neighbor) for letter in self.c_map for neighbor in self.c_map[letter])
+
+        clique_counts = [1]
+        for clique in nx.enumerate_all_cliques(defining_graph):
+            if len(clique) == len(clique_counts):
+                clique_counts.append(0)
+            clique_counts[len(clique)] += 1
+        dimension = len(clique_counts) - 1
+
+        def binomial_power(exponent):
+            # Coefficients of (1 + t)^exponent
+            coefficients = [1]
+            for _ in range(exponent):
+                coefficients = [a + b for a, b in zip(coefficients + [0], [0] + coefficients)]
+            return coefficients
+
+        numerator = binomial_power(dimension)
+        denominator = [0] * (dimension + 1)
+        for k, clique_count in enumerate(clique_counts):
+            for i, coefficient in enumerate(binomial_power(dimension - k)):
+                denominator[i + k] += clique_count * (-1) ** k * coefficient
+
+        # Drop vanishing leading terms of the denominator
+        while len(denominator) > 1 and denominator[-1] == 0:
+            denominator.pop()
+
+        return numerator, denominator
+
+    def growth_rate(self) -> float:
+        """
+        The exponential growth rate of the shortlex language, i.e. the spectral radius of the transfer matrix of the
+        shortlex machine.
+        """
+        rows = self.compile_short_lex_fsm().transitions.tolist()
+        transfer_matrix = np.zeros((len(rows), len(rows)))
+        for state, row in enumerate(rows):
+            for destination in row:
+                if destination >= 0:
+                    transfer_matrix[state, destination] += 1
+
+        return float(max(abs(np.linalg.eigvals(transfer_matrix)), default=0.0))
+
     def visualize_fsm(self, G):
         pos = nx.circular_layout(G, dim=2)
         options = {
@@ -244,19 +501,19 @@ class FSMGenerator:
 
     def locate_associated_state(self, word):
         # Lookup the state in the fiber product FSM that a word would be
-        # Initialize our state at the origin
-        current_state = (''.join(sorted(self.alphabet)), '')
+        if not hasattr(self, 'compiled_fsm'):
+            self.compile_fiber_product_fsm()
 
-        # Traverse the fiber product FSM
-        for l in word:
-            current_state = self.fsm_dict[current_state][l]
-
-        return current_state
+        # Traverse the compiled fiber product FSM from the origin and convert the result back to its string form
+        return self.compiled_fsm.state_tuple(self.compiled_fsm.locate(word))
     
     def all_length_words(self, n):
         """
         Finds all words that have a suffix up to length n with a BFS
         """
+        if not hasattr(self, 'fsm_dict'):
+            self.generate_fiber_product_fsm_as_dict()
+
         n += 1
         fix_words = 'ac' * n
         origin = (''.join(sorted(self.alphabet)), '')
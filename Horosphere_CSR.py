@@ -0,0 +1,167 @@
+import numpy as np
+import networkx
+from Atomic_File import AtomicFile
+
+
+class HorosphereCSR:
+    def __init__(self, letters: list[str], ray: list[str], word_offsets: np.ndarray, word_letters: np.ndarray,
+                 indptr: np.ndarray, indices: np.ndarray, length: int = None, states: np.ndarray = None):
+        """
+        A compact horosphere. Vertices are dense integer ids, their words are kept once in a word table, and the
+        adjacency is a symmetric CSR pair, so every undirected edge costs two int32 entries (about eight bytes).
+
+        The word of vertex i is word_letters[word_offsets[i]:word_offsets[i + 1]] (indices into letters) and its
+        neighbors are indices[indptr[i]:indptr[i + 1]]. Words are stored without the alternating ray prefix, which only
+        depends on the word length and is attached again when a vertex is named.
+
+        :param letters: The alphabet, word_letters holds indices into this list.
+        :param ray: The ray of alternating letters whose prefix is attached to vertex names.
+        :param word_offsets: int64 array of length V + 1, start of each word in word_letters.
+        :param word_letters: uint8 array, the letters of all words concatenated.
+        :param indptr: int64 array of length V + 1, start of each vertex's neighbors in indices.
+        :param indices: int32 array, the neighbors of all vertices concatenated (sorted per vertex).
+        :param length: Length of the longest enumerated ShortLex word, needed to extend the horosphere.
+        :param states: int32 array, the ray product FSM state (HorosphereGenerator.ray_fsm) of every enumerated word and -1 for the words one letter past the last level, needed to extend the horosphere.
+        """
+        self.letters = list(letters)
+        self.ray = list(ray)
+        self.word_offsets = word_offsets
+        self.word_letters = word_letters
+        self.indptr = indptr
+        self.indices = indices
+        self.length = length
+        self.states = states
+
+    @classmethod
+    def from_edges(cls, letters: list[str], ray: list[str], words: list[str], edges_u, edges_v, length: int = None,
+                   states=None):
+        """
+        Build the compact horosphere from a word table and integer edges. Edges may come in either direction and may
+        repeat; duplicates and self-loops are dropped.
+
+        :param letters: The alphabet.
+        :param ray: The ray of alternating letters.
+        :param words: The word (without ray prefix) of every vertex id.
+        :param edges_u: Sequence of vertex ids, one endpoint of every edge.
+        :param edges_v: Sequence of vertex ids, the other endpoint of every edge.
+        :param length: Length of the longest enumerated ShortLex word.
+        :param states: Sequence with the FSM state of every vertex id (-1 when not enumerated).
+        :return: A HorosphereCSR.
+        """
+        word_offsets, word_letters = cls.encode_words(letters, words)
+        indptr, indices = cls.compress_edges(len(words), edges_u, edges_v)
+        if states is not None:
+            states = np.asarray(states, dtype=np.int32)
+        return cls(letters, ray, word_offsets, word_letters, indptr, indices, length, states)
+
+    @staticmethod
+    def encode_words(letters: list[str], words: list[str], start: int = 0):
+        """
+        Encode words as a word table.
+
+        :param letters: The alphabet.
+        :param words: The words to encode.
+        :param start: Offset of the first word, for appending to an existing table.
+        :return: (word_offsets, word_letters), with len(words) + 1 offsets starting at start.
+        """
+        index = {letter: i for i, letter in enumerate(letters)}
+        word_offsets = np.full(len(words) + 1, start, dtype=np.int64)
+        np.cumsum([len(word) for word in words], out=word_offsets[1:])
+        word_offsets[1:] += start
+        word_letters = np.fromiter((index[letter] for word in words for letter in word), dtype=np.uint8,
+                                   count=int(word_offsets[-1] - start))
+        return word_offsets, word_letters
+
+    @staticmethod
+    def compress_edges(number_of_nodes: int, edges_u, edges_v):
+        """
+        Compress integer edges into a symmetric CSR pair, dropping duplicates and self-loops.
+
+        :return: (indptr, indices)
+        """
+        u = np.asarray(edges_u, dtype=np.int64)
+        v = np.asarray(edges_v, dtype=np.int64)
+        keep = u != v
+        u, v = u[keep], v[keep]
+
+        # Both directions of every edge, deduplicated and sorted by (source, target) through a single integer key
+        keys = np.unique(np.concatenate((u * number_of_nodes + v, v * number_of_nodes + u)))
+        sources = keys // number_of_nodes
+        indices = (keys % number_of_nodes).astype(np.int32)
+
+        indptr = np.zeros(number_of_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=number_of_nodes), out=indptr[1:])
+        return indptr, indices
+
+    @property
+    def number_of_nodes(self) -> int:
+        return len(self.word_offsets) - 1
+
+    @property
+    def number_of_edges(self) -> int:
+        return len(self.indices) // 2
+
+    def suffix(self, node: int) -> str:
+        """The word of a vertex without the ray prefix"""
+        start, end = self.word_offsets[node], self.word_offsets[node + 1]
+        return ''.join(self.letters[letter] for letter in self.word_letters[start:end])
+
+    def name(self, node: int) -> str:
+        """The vertex name used by the other horosphere outputs: the word with the alternating ray prefix attached"""
+        suffix = self.suffix(node)
+        ray_string = (self.ray[0] + self.ray[1]) * (len(suffix) // 2 + 1)
+        return ray_string[:len(suffix)] + suffix
+
+    def neighbors(self, node: int) -> np.ndarray:
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def degrees(self) -> np.ndarray:
+        return np.diff(self.indptr)
+
+    def word_lengths(self) -> np.ndarray:
+        return np.diff(self.word_offsets)
+
+    def edges(self):
+        """
+        :return: (sources, targets) arrays holding every undirected edge in both directions.
+        """
+        return np.repeat(np.arange(self.number_of_nodes, dtype=np.int64), self.degrees()), self.indices
+
+    def to_networkx(self) -> networkx.Graph:
+        """Convert to a networkx graph with the same vertex names as HorosphereGenerator.horosphere_as_networkx"""
+        names = [self.name(node) for node in range(self.number_of_nodes)]
+        G = networkx.Graph()
+        G.add_nodes_from(names)
+        sources, targets = self.edges()
+        G.add_edges_from(
+            (names[u], names[v]) for u, v in zip(sources.tolist(), targets.tolist()) if u < v
+        )
+        return G
+
+    def save(self, path: str):
+        """Write the horosphere to a .npz file; written to a temporary name first and then renamed"""
+        arrays = {
+            'letters': np.array(self.letters),
+            'ray': np.array(self.ray),
+            'word_offsets': self.word_offsets,
+            'word_letters': self.word_letters,
+            'indptr': self.indptr,
+            'indices': self.indices
+        }
+        if self.length is not None:
+            arrays['length'] = np.array(self.length)
+        if self.states is not None:
+            arrays['states'] = self.states
+
+        with AtomicFile(path, 'wb') as file:
+            np.savez(file, **arrays)
+
+    @classmethod
+    def load(cls, path: str):
+        with np.load(path) as data:
+            return cls(
+                data['letters'].tolist(), data['ray'].tolist(), data['word_offsets'], data['word_letters'],
+                data['indptr'], data['indices'],
+                int(data['length']) if 'length' in data else None,
+                data['states'] if 'states' in data else None
+            )
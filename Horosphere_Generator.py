@@ -1,13 +1,27 @@
+import os
+import numpy as np
 import networkx
 import matplotlib.colors
-from word import Word, WordGenerator
 from FSM_Generator import FSMGenerator
+from FSM_Cache import FSMCache
+from Compiled_FSM import CompiledFSM, RayProductFSM
+from Horosphere_Writers import GraphMLWriter
+from Horosphere_CSR import HorosphereCSR
+from Edge_Store import EdgeStore, EdgeWindow
+from State_Cache import StateCache
+from Word_Trie import WordTrie, ROOT_LETTER
+from Horosphere_Sampler import LevelSampler
 import networkx as nx
 import matplotlib.pyplot as plt
+from array import array
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
 
 
 class HorosphereGenerator:
-    def __init__(self, commutation_dict: dict[str, set], order_dict: dict[str, int], ray: list[str] = ['a', 'c']):
+    def __init__(self, commutation_dict: dict[str, set], order_dict: dict[str, int], ray: list[str] = ['a', 'c'],
+                 cache: FSMCache = None, compiled_fsm: CompiledFSM = None, state_cache_bytes: int = 32 * 2 ** 20):
         """
         Initialize a Horosphere Generator Object. Using the defining graph of a right-angled coxeter
         group, horosphere's can be created can be created.
@@ -15,13 +29,33 @@ class HorosphereGenerator:
         :param commutation_dict: A dictionary representation of a defining graph. A letter (key) is associated with a list of letters (value) in the dictionary such that all letters in the list commute with the key.
         :param order_dict: A dictionary representation of a total ordering on the letter in the defining graph. A letter (key) is associated with an index (value) that represents that letters relative position in the ordering.
         :param ray: A list representing our ray of alternating letters (typically 'a' and 'c').
+        :param cache: An optional on-disk cache of compiled machines, so the FSMs are only built once per defining graph.
+        :param compiled_fsm: An already compiled fiber product FSM (e.g. memory-mapped with CompiledFSM.load); no FSM is built when given.
+        :param state_cache_bytes: Byte budget of the LRU cache of located word states (see state_cache); 0 disables it.
         """
         self.c_map = commutation_dict
         self.o_map = order_dict
         self.alphabet = set().union(letter for letter in self.o_map)
         self.ray = ray
-        fsm_gen = FSMGenerator(self.c_map, self.o_map)
-        self.fiber_product_fsm = fsm_gen.generate_fiber_product_fsm_as_dict()
+        fsm_gen = FSMGenerator(self.c_map, self.o_map, cache=cache)
+        self.language = fsm_gen.language
+        self.letter_masks = fsm_gen.letter_masks
+        if compiled_fsm is None and cache is None:
+            # Only the fiber product is used, the factor machines are only compiled to be stored in a cache
+            compiled_fsm = fsm_gen.compile_fiber_product_fsm()
+        elif compiled_fsm is None:
+            compiled_fsm = fsm_gen.compiled_machines()['fiber_product']
+        self.compiled_fsm = compiled_fsm
+        # Follows every word together with its two ray prefixed words; words are enumerated with this machine
+        self.ray_fsm = RayProductFSM.from_fiber_product(compiled_fsm, self.letter_masks, ray)
+        self.ray_mask = self.letter_masks.mask(ray)
+        # Ray product states of located words; state_cache.stats() reports hits and misses for tuning the budget
+        self.state_cache = StateCache(state_cache_bytes)
+
+    @property
+    def fiber_product_fsm(self) -> dict:
+        """The fiber product FSM in its dictionary form, exported from the compiled FSM on demand"""
+        return self.compiled_fsm.to_fsm_dict()
 
     def locate_associated_state(self, word: str):
         """
@@ -33,12 +67,80 @@ class HorosphereGenerator:
         :param word: The word for which we want to find the associated fiber product FSM state.
         :return: A fiber product FSM state (A, B) where A denotes the letters that can be written while keeping the word short-lex and B denotes the letters that can be commuted to be last in the word.
         """
-        current_state = (''.join(sorted(self.alphabet)), '')
-        # Lookup in this sense is linear with respect to length of our word
-        for letter in word:
-            current_state = self.fiber_product_fsm[current_state][letter]
+        # Lookup in this sense is linear with respect to length of our word, each step is one transition table lookup
+        return self.ray_fsm.state_tuple(self.locate_ray_state(word))
 
-        return current_state
+    def locate_ray_state(self, word: str) -> int:
+        """
+        Find the ray product FSM state of a word through the state cache. On a miss the traversal continues from the
+        state of the word without its last letter when that one is cached, which is the common case for words visited
+        in BFS order.
+
+        :param word: A short-lex word; words that are not strings (e.g. a Word or a list of letters) bypass the cache.
+        :return: The integer state of word in ray_fsm.
+        """
+        if not isinstance(word, str):
+            return self.ray_fsm.locate(word)
+
+        state = self.state_cache.get(word)
+        if state is None:
+            parent_state = self.state_cache.peek(word[:-1]) if word else None
+            if parent_state is None:
+                state = self.ray_fsm.locate(word)
+            else:
+                state = self.ray_fsm.locate(word[-1:], parent_state)
+            self.state_cache.put(word, state)
+        return state
+
+    def iter_words_by_level(self, n: int):
+        """
+        Generates all short-lex words with a suffix up to length n level by level with a BFS. Every word carries its
+        ray product FSM state (see ray_fsm), so each emitted word costs a single transition; only one level is held in
+        memory.
+
+        :param n: The depth with which the BFS will be conducted.
+        :return: A generator yielding, for every length 0..n, a deque of (word, state) pairs of that length in BFS order.
+        """
+        # All elements of a level are of the form (word, node)
+        level = deque([('', self.ray_fsm.origin)])
+
+        for depth in range(n + 1):
+            yield level
+
+            if depth == n:
+                break
+
+            level = self.next_level(level, depth)
+
+    def next_level(self, level, depth: int):
+        """
+        One step of the level by level BFS.
+
+        :param level: Iterable of (word, state) pairs, all of length depth.
+        :param depth: The length of the words in level.
+        :return: A deque of the (word, state) pairs of length depth + 1, in BFS order.
+        """
+        successors = self.ray_fsm.successors
+
+        next_level = deque()
+        for word, node in level:
+            for next_letter, next_node in successors[node]:
+                # Ignore words that start with the letters in our ray
+                if depth == 0 and (next_letter == self.ray[0] or next_letter == self.ray[1]):
+                    continue
+                next_level.append((word + next_letter, next_node))
+        return next_level
+
+    def iter_all_length_n_words(self, n: int):
+        """
+        Generator form of get_all_length_n_words.
+
+        :param n: The depth with which the BFS will be conducted.
+        :return: A generator of all possible short-lex words up to length n, shortest first.
+        """
+        for level in self.iter_words_by_level(n):
+            for word, _ in level:
+                yield word
 
     def get_all_length_n_words(self, n: int):
         """
@@ -47,32 +149,145 @@ class HorosphereGenerator:
         :param n: The depth with which the BFS will be conducted. The algorithm will compute all short-lex words of this length.
         :return: All possible short-lex words of length n.
         """
-        n += 1
-        origin = (''.join(sorted(self.alphabet)), '')
+        return list(self.iter_all_length_n_words(n))
+    
+    def get_word_trie(self, n: int) -> WordTrie:
+        """
+        Finds all words that have a suffix up to length n with a BFS, like get_all_length_n_words, but stores them as a
+        prefix trie in array form: every word costs its last letter, ray product FSM state, parent and depth instead of
+        a string.
 
-        # All elements of the frontier are of the form (node, current depth, word)
-        frontier = [(origin, 0, '')]
-        # We will add the words to words_out
-        words_out = []
+        The trie can be passed to horosphere_as_csr, which then takes the words and their FSM states from it instead of
+        enumerating them again. The adjacency computation itself still works on the words spelled as strings.
 
-        while frontier:
-            node, depth, word = frontier.pop(0)
-            # Only go to depth n
-            if depth == n:
-                continue
+        :param n: The depth with which the BFS will be conducted.
+        :return: A WordTrie whose node ids follow the order of get_all_length_n_words.
+        """
+        successors = [
+            [(self.ray_fsm.letter_index[letter], destination) for letter, destination in row]
+            for row in self.ray_fsm.successors
+        ]
+        ray_letters = {self.ray_fsm.letter_index[letter] for letter in self.ray}
+
+        letter = array('B', [ROOT_LETTER])
+        state = array('i', [self.ray_fsm.origin])
+        parent = array('i', [-1])
+        depth = array('H', [0])
+
+        level_start, level_end = 0, 1
+        for level_depth in range(n):
+            for node in range(level_start, level_end):
+                for next_letter, next_state in successors[state[node]]:
+                    # Ignore words that start with the letters in our ray
+                    if level_depth == 0 and next_letter in ray_letters:
+                        continue
+                    letter.append(next_letter)
+                    state.append(next_state)
+                    parent.append(node)
+                    depth.append(level_depth + 1)
+            level_start, level_end = level_end, len(letter)
+
+        return WordTrie(
+            self.ray_fsm.letters, np.frombuffer(letter, dtype=np.uint8), np.frombuffer(state, dtype=np.int32),
+            np.frombuffer(parent, dtype=np.int32), np.frombuffer(depth, dtype=np.uint16)
+        )
+
+    def count_horosphere(self, n: int) -> dict:
+        """
+        Predict the size of the horosphere of length n without enumerating it, by pushing word counts through the ray
+        product FSM with Python integers. With S(w) the letters that lengthen w to a neighbor, i.e. the letters that are
+        neither last in w nor a ray letter commuting with all of w:
+
+            - the same length edges of level k are sum over w of level k - 1 of |S(w)| choose 2 (every pair of letters
+              of S(w) gives one edge, and different reduced words never give the same edge)
+            - the edges between level k and k + 1 are sum over w of level k with ray[k % 2] commuting with w of |S(w)|
+              (the shortening edges are the same edges seen from the other end)
+            - the words of length n + 1 reached from level n are those with a last letter whose removal leaves a word
+              commuting with ray[n % 2]; the set E(w) of such last letters is carried along with the state:
+              E(wz) = ({z} if ray commutes with w) | (E(w) & N(z) if ray commutes with z)
+
+        The numbers are exact for any n; the cost is linear in n and in the number of (state, E) pairs.
+
+        :param n: Length of the longest ShortLex word, as passed to horosphere_as_networkx.
+        :return: A dictionary with the number of words per level ('level_sizes', lengths 0..n), the number of reached words of length n + 1 ('boundary_size'), the same length edges per level ('same_length_edges', lengths 0..n), the edges between level k and k + 1 ('different_length_edges', k = 0..n) and the totals ('vertices', 'edges').
+        """
+        masks = self.letter_masks
+        if sorted(self.o_map[letter] for letter in self.ray) != [0, 1]:
+            raise ValueError("Counting requires the ray letters to be the first two letters of the ordering")
+
+        rows = self.ray_fsm.transitions.tolist()
+        letter_bits = [masks.bit[letter] for letter in self.ray_fsm.letters]
+        neighborhoods = [masks.neighborhood[letter] for letter in self.ray_fsm.letters]
+        ray_indices = {self.ray_fsm.letter_index[letter] for letter in self.ray}
+
+        # Per state: which ray letters commute with the whole word, and the number of lengthening letters |S(w)|
+        ray_commuting = [
+            [bool(ray_last[i] & ~last) for i in range(2)] for last, ray_last in
+            zip(self.ray_fsm.last_masks.tolist(), self.ray_fsm.ray_last_masks.tolist())
+        ]
+        # L(ray[0]w) | L(ray[1]w) is L(w) together with the ray letters commuting with w
+        lengthening = [bin(masks.full_mask & ~(ray_last[0] | ray_last[1])).count('1')
+                       for ray_last in self.ray_fsm.ray_last_masks.tolist()]
+
+        # The boundary is reached through ray[n % 2]; counts[(state, E)] is the number of words of the current length
+        boundary_ray = n % 2
+        boundary_ray_neighborhood = masks.neighborhood[self.ray[boundary_ray]]
+        counts = {(self.ray_fsm.origin, 0): 1}
+
+        level_sizes, same_length_edges, different_length_edges = [], [0], []
+        for depth in range(n + 1):
+            state_counts = [0] * len(rows)
+            for (state, _), count in counts.items():
+                state_counts[state] += count
+
+            level_sizes.append(sum(state_counts))
+            same = 0
+            different = 0
+            for state, count in enumerate(state_counts):
+                if count == 0:
+                    continue
+                same += count * (lengthening[state] * (lengthening[state] - 1) // 2)
+                if ray_commuting[state][depth % 2]:
+                    different += count * lengthening[state]
+            if depth < n:
+                same_length_edges.append(same)
+            different_length_edges.append(different)
+
+            next_counts = {}
+            for (state, last_mask), count in counts.items():
+                commutes = ray_commuting[state][boundary_ray]
+                for i, destination in enumerate(rows[state]):
+                    # Ignore words that start with the letters in our ray
+                    if destination < 0 or (depth == 0 and i in ray_indices):
+                        continue
+                    next_last_mask = (letter_bits[i] if commutes else 0) | (
+                        last_mask & neighborhoods[i] if boundary_ray_neighborhood & letter_bits[i] else 0
+                    )
+                    key = (destination, next_last_mask)
+                    next_counts[key] = next_counts.get(key, 0) + count
+            counts = next_counts
+
+        boundary_size = sum(count for (_, last_mask), count in counts.items() if last_mask)
+
+        return {
+            'level_sizes': level_sizes,
+            'boundary_size': boundary_size,
+            'same_length_edges': same_length_edges,
+            'different_length_edges': different_length_edges,
+            'vertices': sum(level_sizes) + boundary_size,
+            'edges': sum(same_length_edges) + sum(different_length_edges)
+        }
 
-            # Ignore words that start with the letters in our ray
-            if word.startswith(self.ray[0]) or word.startswith(self.ray[1]):
-                continue
-            
-            words_out.append(word)
+    def level_sampler(self, n: int, seed: int = None) -> LevelSampler:
+        """
+        A sampler drawing words uniformly from level n, for statistics of horospheres too large to enumerate.
 
-            # Continue traversing
-            for next_letter in self.locate_associated_state(word)[0]:
-                frontier.append((self.fiber_product_fsm[node][next_letter], depth+1, word + next_letter))
+        :param n: The length of the sampled words.
+        :param seed: Seed for reproducible samples.
+        :return: A LevelSampler; see its sample and sample_batch methods.
+        """
+        return LevelSampler(self, n, seed)
 
-        return words_out
-    
     def calculate_same_length_word_adj(self, word: str):
         """
         Given a word, "word", find all connections to same length words on the horosphere
@@ -81,153 +296,435 @@ class HorosphereGenerator:
         :return: The list of all such same length words.
         """
 
-        # Edge case: empty string "" 
+        # Edge case: empty string "" has no same length neighbors
         if len(word) == 0:
-            return [word]
+            return []
         
         adjacencies = []
+        masks = self.letter_masks
 
-        # Find the node in the FSM where the word is located 
-        word_node = self.locate_associated_state(word)
+        # The word carries its FSM state, so reduced words are derived from it instead of being traversed from scratch
+        state_word = self.language.state_word(word)
 
-        for last_letter in word_node[1]:
+        for last_letter in masks.string_of(state_word.last_letters_mask):
 
             # Remove the first instance of the last letter from the right end of the word; This is our reduced word
-            reduced_word = Word(word[::-1].replace(last_letter, '', 1)[::-1], self.c_map, self.o_map)
-
-            reduced_word_state = self.locate_associated_state(reduced_word)
+            reduced_word = state_word.copy().delete_last_occurrence(last_letter)
 
-            # Append 'a' or 'c' to the beginning of the reduced word
-            a_aug_word_state = self.locate_associated_state(reduced_word.copy().insert(0, self.ray[0]))
-            c_aug_word_state = self.locate_associated_state(reduced_word.copy().insert(0, self.ray[1]))
-
-            # Deal with the issue of words commuting all the way forward
-            connecting_letters = self.alphabet.copy().difference(set(reduced_word_state[1]))
-            ray_augmented_letters = set(a_aug_word_state[1]).union(set(c_aug_word_state[1]))
-            
-            # The extra difference of set(reduced_word_state[1]) here is unnecessary
-            connecting_letters = connecting_letters.difference(ray_augmented_letters.difference(set(reduced_word_state[1])))
+            # Deal with the issue of words commuting all the way forward; letters that are last in the reduced word or
+            # in one of its ray augmented words cannot connect. The augmented words (ray letter at the front) only add
+            # the ray letters that commute with the whole reduced word to its last letters, L(xw) = L(w) | ({x} & C(w))
+            connecting_letters = masks.full_mask & ~(
+                reduced_word.last_letters_mask | (self.ray_mask & reduced_word.commuting_letters_mask)
+            )
 
             # Lengthen the reduced word by its (shortlex) legal next letters to get all same length adjacent words
-            for letter in connecting_letters:
+            for letter in masks.letters_of(connecting_letters):
                 adjacencies.append((word, reduced_word.copy().shortlex_append(letter)))
 
         return adjacencies
 
         # By construction, word cannot start with 'a' or 'c' as this would cause issues with the latter added prefix
 
-    def calculate_different_length_adj(self, word: str):
+    def calculate_different_length_adj(self, word: str, state: int = None):
         """
         Given a word, "word", find all connections to different length words on the horosphere.
         If the word has length n, then the different length connections we find will have length n+2.
 
         :param word: A word that does NOT start with the ray to infinity on the horosphere.
+        :param state: The ray product FSM state of word (as carried by iter_words_by_level); located when not given.
         :return: The list of all such different length words.
         """
+        if state is None:
+            state = self.locate_ray_state(word)
 
-        # "suffix" is the word without the ray at the beginning
-        suffix = Word(word, self.c_map, self.o_map)
-        suffix_state = self.locate_associated_state(suffix)
-
-        # Append 'a' or 'c' to the beginning of the reduced word
-        a_suffix_state = self.locate_associated_state(suffix.copy().insert(0, self.ray[0]))
-        c_suffix_state = self.locate_associated_state(suffix.copy().insert(0, self.ray[1]))
+        # The last letters of the suffix (the word without the ray at the beginning) and of the suffix with 'a' or 'c'
+        # appended to its beginning all come from the one ray product state
+        suffix_last_mask, a_suffix_last_mask, c_suffix_last_mask = self.ray_fsm.ray_last_lists[state]
 
         # Need better variable name, the contents of this set represent which letters can commute forward and cause
         # issue with the prefix of a word. This set will only ever have either 'a', 'c', or will be empty
-        ac_suffix_state = set(a_suffix_state[1]).union(set(c_suffix_state[1])).difference(set(suffix_state[1]))
+        ac_suffix_mask = (a_suffix_last_mask | c_suffix_last_mask) & ~suffix_last_mask
+        ac_suffix_state = self.letter_masks.letters_of(ac_suffix_mask)
 
         # If there are no such issues, then there are no different length adjacent words; exit
         if len(ac_suffix_state) == 0:
             return []
 
+        suffix = self.language.state_word(word)
+        suffix_last_letters = self.letter_masks.string_of(suffix_last_mask)
+
         adjacencies = []
 
         # Word (suffix) has even length
         if len(suffix) % 2 == 0:
             if self.ray[0] in ac_suffix_state:
                 # Lengthen word by a (shortlex) legal next letter 
-                for next_letter in self.alphabet.copy().difference(set(suffix_state[1])).difference(ac_suffix_state):
+                for next_letter in self.letter_masks.letters_of(
+                        self.letter_masks.full_mask & ~suffix_last_mask & ~ac_suffix_mask):
                     adjacencies.append([word, suffix.copy().shortlex_append(next_letter)])
                 pass
             if self.ray[1] in ac_suffix_state:
                 # Shorten word by one of its possible last letters
-                for last_letter in suffix_state[1]:
+                for last_letter in suffix_last_letters:
                     adjacencies.append([word, word[::-1].replace(last_letter, '', 1)[::-1]])
 
         # Word (suffix) has odd length
         else:
             if self.ray[0] in ac_suffix_state:
                 # Shorten
-                for last_letter in suffix_state[1]:
+                for last_letter in suffix_last_letters:
                     adjacencies.append([word, word[::-1].replace(last_letter, '', 1)[::-1]])
             if self.ray[1] in ac_suffix_state:
                 # Lengthen
-                for next_letter in self.alphabet.copy().difference(set(suffix_state[1])).difference(ac_suffix_state):
+                for next_letter in self.letter_masks.letters_of(
+                        self.letter_masks.full_mask & ~suffix_last_mask & ~ac_suffix_mask):
                     adjacencies.append([word, suffix.copy().shortlex_append(next_letter)])
         return adjacencies
 
-    def calculate_word_adj(self, word):
+    def calculate_word_adj(self, word, state: int = None):
         """
         Use "calculate_same_length_word_adj" and "calculate_different_length_adj" to find all adjacent words overall.
 
         :param word: A word that does NOT start with the ray to infinity on the horosphere.
+        :param state: The ray product FSM state of word, if known.
         :return: All adjacent words.
         """
 
         adjacencies = []
         adjacencies.extend(self.calculate_same_length_word_adj(word))
-        adjacencies.extend(self.calculate_different_length_adj(word))
+        adjacencies.extend(self.calculate_different_length_adj(word, state))
         return adjacencies
 
-    def calculate_horosphere_edges(self, word_list: list[str], length: int):
+    def vertex_suffix(self, vertex: str) -> str:
+        """
+        Convert a horosphere vertex to its suffix and check that it is one. A vertex can be given by its full name, the
+        alternating ray prefix followed by the suffix (as in the graphs written by this class), or by the suffix alone;
+        a suffix never starts with a ray letter, so the two cannot be confused.
+
+        :param vertex: A full vertex name or a suffix.
+        :return: The suffix, a short-lex word that does NOT start with the ray.
+        """
+        suffix = vertex
+        if vertex and vertex[0] in self.ray:
+            half = len(vertex) // 2
+            ray_string = (self.ray[0] + self.ray[1]) * (half // 2 + 1)
+            if len(vertex) % 2 != 0 or vertex[:half] != ray_string[:half]:
+                raise ValueError(f"{vertex!r} is neither a suffix nor a vertex name with the ray prefix {self.ray}")
+            suffix = vertex[half:]
+
+        unknown = set(suffix) - self.alphabet
+        if unknown:
+            raise ValueError(f"{vertex!r} contains letters that are not in the defining graph: {sorted(unknown)}")
+        if suffix and suffix[0] in self.ray:
+            raise ValueError(f"{vertex!r} is not on the horosphere, its suffix starts with a ray letter")
+        try:
+            self.locate_ray_state(suffix)
+        except KeyError:
+            raise ValueError(f"{vertex!r} is not short-lex") from None
+        return suffix
+
+    def vertex_name(self, suffix: str) -> str:
+        """The full vertex name of a suffix: the alternating ray prefix of the same length followed by the suffix"""
+        ray_string = (self.ray[0] + self.ray[1]) * (len(suffix) // 2 + 1)
+        return ray_string[:len(suffix)] + suffix
+
+    def neighbors(self, vertex: str) -> list[str]:
+        """
+        The neighbors of one horosphere vertex, computed from the word alone in O(n * |alphabet|) without enumerating
+        the horosphere; word states go through the state cache, so queries around one region stay cheap.
+
+        Besides the adjacencies found by calculate_word_adj, a word is the lengthening of every word obtained by deleting
+        one of its last letters that commutes with the ray letter of its parity; those edges are only found from the
+        shorter word.
+
+        :param vertex: A full vertex name or a suffix (see vertex_suffix).
+        :return: The full names of the neighbors, shortest first.
+        """
+        suffix = self.vertex_suffix(vertex)
+        return [self.vertex_name(neighbor) for neighbor in self.__neighbor_suffixes(suffix)]
+
+    def __neighbor_suffixes(self, suffix: str) -> list[str]:
+        """The suffixes of the neighbors of a validated suffix, shortest first"""
+        neighbors = set()
+
+        for _, neighbor in self.calculate_word_adj(suffix, self.locate_ray_state(suffix)):
+            neighbors.add(str(neighbor))
+
+        # Incoming lengthening edges from the words one letter shorter
+        if suffix:
+            state_word = self.language.state_word(suffix)
+            ray_bit = self.letter_masks.bit[self.ray[(len(suffix) - 1) % 2]]
+            for last_letter in self.letter_masks.letters_of(state_word.last_letters_mask):
+                shorter_word = state_word.copy().delete_last_occurrence(last_letter)
+                if shorter_word.commuting_letters_mask & ray_bit:
+                    neighbors.add(str(shorter_word))
+
+        neighbors.discard(suffix)
+        return sorted(neighbors, key=lambda word: (len(word), word))
+
+    def degree(self, vertex: str) -> int:
+        """
+        :param vertex: A full vertex name or a suffix (see vertex_suffix).
+        :return: The number of neighbors of the vertex on the horosphere.
+        """
+        return len(self.neighbors(vertex))
+
+    def local_patch(self, center_word: str, radius: int, as_csr: bool = False):
+        """
+        The ball of the given radius around one vertex of the horosphere, found with a BFS over per-word neighbor
+        queries (see neighbors). The cost is proportional to the size of the patch; the depth of the center only enters
+        through the O(n) state lookup of every word.
+
+        :param center_word: A full vertex name or a suffix (see vertex_suffix).
+        :param radius: The largest graph distance from the center.
+        :param as_csr: Return a HorosphereCSR (ids in BFS order, the center is 0) instead of a networkx graph.
+        :return: The subgraph induced by the ball; networkx nodes carry their distance from the center as "distance".
+        """
+        center = self.vertex_suffix(center_word)
+        distances = {center: 0}
+        # The BFS order; edges of vertices on the sphere of the given radius are only kept inside the ball
+        order = [center]
+        edges = []
+
+        frontier = deque([center])
+        while frontier:
+            word = frontier.popleft()
+            for neighbor in self.__neighbor_suffixes(word):
+                if neighbor not in distances:
+                    if distances[word] == radius:
+                        continue
+                    distances[neighbor] = distances[word] + 1
+                    order.append(neighbor)
+                    frontier.append(neighbor)
+                edges.append((word, neighbor))
+
+        if as_csr:
+            node_ids = {word: node for node, word in enumerate(order)}
+            return HorosphereCSR.from_edges(
+                self.letter_masks.letters, self.ray, order,
+                [node_ids[u] for u, _ in edges], [node_ids[v] for _, v in edges]
+            )
+
+        G = networkx.Graph()
+        G.add_nodes_from((self.vertex_name(word), {'distance': distances[word]}) for word in order)
+        G.add_edges_from((self.vertex_name(u), self.vertex_name(v)) for u, v in edges)
+        return G
+
+    def calculate_word_adj_parallel(self, word_list: list[str], max_workers: int = None, shard_size: int = None):
+        """
+        Compute the adjacencies of every word in a process pool. The word list is cut into contiguous shards (words are
+        ordered by level and leading letters, so a shard covers a few neighboring subtrees). Every worker receives the
+        compiled fiber product FSM once when it starts instead of rebuilding the FSMs, and shards are merged in order,
+        so the result is identical to calling calculate_word_adj on every word in turn.
+
+        :param word_list: List of ShortLex words that do NOT start with the ray.
+        :param max_workers: Number of worker processes, by default the number of CPUs.
+        :param shard_size: Number of words per task, by default enough for about four tasks per worker.
+        :return: All adjacencies, with adjacent words converted to strings.
+        """
+        max_workers = max_workers or os.cpu_count() or 1
+        if shard_size is None:
+            shard_size = max(1, -(-len(word_list) // (4 * max_workers)))
+        shards = [word_list[i:i + shard_size] for i in range(0, len(word_list), shard_size)]
+
+        adjacencies = []
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_initialize_worker,
+                                 initargs=(self.c_map, self.o_map, self.ray, self.compiled_fsm)) as executor:
+            for shard_adjacencies in executor.map(_calculate_shard_adj, shards):
+                adjacencies.extend(shard_adjacencies)
+
+        return adjacencies
+
+    def calculate_horosphere_edges(self, word_list: list[str], length: int, max_workers: int = None,
+                                   edge_store: EdgeStore = None):
         """
         Add all the edges to the horosphere. 
 
         :param word_list: List of all ShortLex words (prefixes).
         :param length: Length of the longest ShortLex word.
-        :return: All edges on the graph.
+        :param max_workers: When more than one, the adjacencies are computed in a process pool of this size (see calculate_word_adj_parallel).
+        :param edge_store: The EdgeStore the edges are collected in; pass one to read back how many adjacencies collapsed into each edge.
+        :return: All edges on the graph, every undirected edge once and without self-loops.
         """
+        if edge_store is None:
+            edge_store = EdgeStore()
 
-        # Intialize the string "acacac..."
-        ray_string = (self.ray[0] + self.ray[1]) * length
+        # Find all adjacencies on the horosphere.
+        if max_workers is not None and max_workers > 1:
+            adjacencies = self.calculate_word_adj_parallel(word_list, max_workers)
+        else:
+            adjacencies = (edge for word in word_list for edge in self.calculate_word_adj(word))
 
-        edges = []
-        edges_set = set()
-        processed_edges = []
-
-        # Extend edges with all adjacencies on the horosphere.
-        for word in word_list:
-            edges.extend(self.calculate_word_adj(word))
-
-        # Append the prefix to our edges
-        for edge in edges:
-            prefix_edge = []
-            for u in edge:
-                # idx = 0
-                prefix = ray_string[:len(u)]
-                # for i in range(len(u)):
-                #     prefix = prefix + self.ray[idx]
-                #     idx = (idx + 1) % 2
-                prefix_edge.append(prefix + str(u))
-            processed_edges.append(prefix_edge)
-            edges_set.add(tuple(prefix_edge))
-
-        processed_edges.pop(0)
-        processed_edges = [edge for edge in processed_edges if edge[0] != edge[1]]
-        return processed_edges
-
-    def horosphere_as_networkx(self, length):
-        words = self.get_all_length_n_words(length)
-        print(f"Words of length {length} calculated: \n\t\t {len(words)} words found")
-        processed_edges = self.calculate_horosphere_edges(words, length)
-        print(f"Words processing completed: \n\t\t {len(words)} words processed")
+        # Append the prefix to our edges; the store drops the second copy of each edge and self-loops
+        for u, v in adjacencies:
+            edge_store.add_edge(self.vertex_name(str(u)), self.vertex_name(str(v)))
+
+        return edge_store.edges()
+
+    def iter_horosphere_edges(self, length: int):
+        """
+        Stream the edges of the horosphere without materializing the word list, the edge list or the graph. Words come
+        from the level by level enumerator, their adjacencies are computed one word at a time, and every undirected edge
+        is yielded once with the ray prefix attached.
 
+        An edge joins words whose lengths differ by at most one, so once a level has been processed no edge whose longer
+        word is at most that long can come up again. Only those recent edges are kept for deduplication.
+
+        :param length: Length of the longest ShortLex word.
+        :return: A generator of (u, v) vertex name pairs.
+        """
+        window = EdgeWindow()
+
+        for depth, level in enumerate(self.iter_words_by_level(length)):
+            for word, state in level:
+                for u, v in self.calculate_word_adj(word, state):
+                    edge = window.add_edge(str(u), str(v))
+                    if edge is not None:
+                        yield self.vertex_name(edge[0]), self.vertex_name(edge[1])
+
+            window.forget(depth)
+
+    def write_horosphere(self, length: int, sink):
+        """
+        Stream the edges of the horosphere into a sink.
+
+        :param length: Length of the longest ShortLex word.
+        :param sink: Any object with an add_edge(u, v) method, e.g. a networkx.Graph or a Horosphere_Writers.EdgeListWriter.
+        :return: The number of edges written.
+        """
+        number_of_edges = 0
+        for u, v in self.iter_horosphere_edges(length):
+            sink.add_edge(u, v)
+            number_of_edges += 1
+        return number_of_edges
+
+    def horosphere_as_networkx(self, length, max_workers=None):
         G = networkx.Graph()
-        G.add_edges_from(processed_edges)
+        if max_workers is not None and max_workers > 1:
+            words = self.get_all_length_n_words(length)
+            G.add_edges_from(self.calculate_horosphere_edges(words, length, max_workers=max_workers))
+        else:
+            self.write_horosphere(length, G)
         print(f"Length {length} Horosphere generated: \n\t\t {G}")
         return G
 
+    def horosphere_as_csr(self, length: int, trie: WordTrie = None) -> HorosphereCSR:
+        """
+        Compute the horosphere with dense integer vertex ids instead of prefixed strings. Ids are assigned in the order
+        words are enumerated (shortest first), followed by the words one letter past the last level that are only
+        reached through an edge. Edges are collected as integer pairs and compressed into CSR form.
+
+        :param length: Length of the longest ShortLex word.
+        :param trie: The words as returned by get_word_trie (of at least this length); its levels and stored FSM states are used instead of enumerating the words again.
+        :return: A HorosphereCSR; use its to_networkx method to get the graph returned by horosphere_as_networkx.
+        """
+        node_ids = {}
+        words = []
+        states = array('i')
+        edges_u, edges_v = array('q'), array('q')
+
+        if trie is None:
+            levels = self.iter_words_by_level(length)
+        elif trie.max_depth < length:
+            raise ValueError(f"The trie only holds words up to length {trie.max_depth}, not {length}")
+        else:
+            levels = islice(trie.iter_levels(), length + 1)
+
+        for level in levels:
+            self.__add_level_edges(level, node_ids, words, states, edges_u, edges_v)
+
+        horosphere = HorosphereCSR.from_edges(
+            self.letter_masks.letters, self.ray, words, edges_u, edges_v, length=length, states=states
+        )
+        print(f"Length {length} Horosphere generated: \n\t\t {horosphere.number_of_nodes} nodes and "
+              f"{horosphere.number_of_edges} edges")
+        return horosphere
+
+    def extend_horosphere(self, horosphere: HorosphereCSR) -> HorosphereCSR:
+        """
+        Extend a horosphere of length n (as returned by horosphere_as_csr, or loaded from its .npz file) to length n + 1.
+        Only the new level is enumerated, from the stored FSM states of the words of length n, and only the adjacencies
+        of the new words are computed; the stored words and edges are carried over as arrays.
+
+        :param horosphere: A HorosphereCSR with length and states, computed with the same defining graph and ray.
+        :return: The HorosphereCSR of length n + 1. Existing vertices keep their ids.
+        """
+        if horosphere.length is None or horosphere.states is None:
+            raise ValueError("The horosphere has no stored length and FSM states to extend from")
+        if horosphere.letters != self.letter_masks.letters or horosphere.ray != self.ray:
+            raise ValueError("The horosphere was computed with a different alphabet or ray")
+
+        length = horosphere.length
+        word_lengths = horosphere.word_lengths()
+
+        # An edge of a new word reaches words of length n to n + 2, so only words of length n and up need to be looked up
+        node_ids = {horosphere.suffix(node): node for node in np.flatnonzero(word_lengths >= length).tolist()}
+        level = [(horosphere.suffix(node), int(horosphere.states[node]))
+                 for node in np.flatnonzero(word_lengths == length).tolist()]
+
+        # New vertices are numbered after the existing ones; the lists only hold what is added here
+        words = [None] * horosphere.number_of_nodes
+        states = array('i', horosphere.states.tolist())
+        edges_u, edges_v = array('q'), array('q')
+        self.__add_level_edges(self.next_level(level, length), node_ids, words, states, edges_u, edges_v)
+
+        new_words = words[horosphere.number_of_nodes:]
+        word_offsets, word_letters = HorosphereCSR.encode_words(
+            horosphere.letters, new_words, start=int(horosphere.word_offsets[-1])
+        )
+        sources, targets = horosphere.edges()
+        indptr, indices = HorosphereCSR.compress_edges(
+            len(words), np.concatenate((sources, edges_u)), np.concatenate((targets, edges_v))
+        )
+
+        extended = HorosphereCSR(
+            horosphere.letters, horosphere.ray,
+            np.concatenate((horosphere.word_offsets, word_offsets[1:])),
+            np.concatenate((horosphere.word_letters, word_letters)),
+            indptr, indices, length + 1, np.asarray(states, dtype=np.int32)
+        )
+        print(f"Length {length + 1} Horosphere generated: \n\t\t {extended.number_of_nodes} nodes and "
+              f"{extended.number_of_edges} edges")
+        return extended
+
+    def __add_level_edges(self, level, node_ids: dict, words: list, states: array, edges_u: array, edges_v: array):
+        """
+        Number the words of a level and collect the integer edges of their adjacencies. Words are given the next free
+        id the first time they are seen, either when enumerated or as the endpoint of an edge.
+
+        :param level: Iterable of (word, state) pairs of one length.
+        :param node_ids: Map from word to id, updated in place.
+        :param words: Word of every id, updated in place.
+        :param states: FSM state of every id (-1 until the word is enumerated), updated in place.
+        :param edges_u: One endpoint of every edge, appended to.
+        :param edges_v: The other endpoint of every edge, appended to.
+        """
+        def node_id(word: str) -> int:
+            if word not in node_ids:
+                node_ids[word] = len(words)
+                words.append(word)
+                states.append(-1)
+            return node_ids[word]
+
+        for word, state in level:
+            u = node_id(word)
+            states[u] = state
+            for _, neighbor in self.calculate_word_adj(word, state):
+                edges_u.append(u)
+                edges_v.append(node_id(str(neighbor)))
+
+    def save_horosphere_as_csr(self, horosphere_length: int, horosphere_type="horosphere"):
+        """
+        Save the compact horosphere (see horosphere_as_csr) to Horosphere_Graphml/ as a .npz file.
+
+        :param horosphere_length: Length of the longest ShortLex word.
+        :param horosphere_type: Name of the defining graph, used in the file name.
+        """
+        path = f"Horosphere_Graphml/{horosphere_type}_length_{horosphere_length}.npz"
+        self.horosphere_as_csr(horosphere_length).save(path)
+        print(f"Length {horosphere_length} Horosphere saved: \n\t\t {path}")
+
     @staticmethod
     def visualize_horosphere(G):
         pos = nx.spring_layout(G, dim=2)
@@ -244,10 +741,45 @@ class HorosphereGenerator:
         nx.draw(G, pos, **options)
         plt.show()
 
-    def save_horosphere_as_graphml(self, horosphere_length, G=None, horosphere_type="horosphere"):
-        if G is None:
-            G = self.horosphere_as_networkx(horosphere_length)
-        nx.write_graphml_lxml(G, f"Horosphere_Graphml/{horosphere_type}_length_{horosphere_length}.graphml")
+    def save_horosphere_as_graphml(self, horosphere_length, G=None, horosphere_type="horosphere", compress=False):
+        """
+        Save a horosphere to Horosphere_Graphml/. Without a graph, the horosphere is streamed straight into the file
+        and never built in memory.
+
+        :param horosphere_length: Length of the longest ShortLex word.
+        :param G: An already computed horosphere to save instead.
+        :param horosphere_type: Name of the defining graph, used in the file name.
+        :param compress: Gzip the file (adds a ".gz" suffix).
+        """
+        path = f"Horosphere_Graphml/{horosphere_type}_length_{horosphere_length}.graphml"
+        if compress:
+            path += ".gz"
+
+        if G is not None:
+            nx.write_graphml_lxml(G, path)
+            return
+
+        with GraphMLWriter(path, compress=compress) as writer:
+            self.write_horosphere(horosphere_length, writer)
+        print(f"Length {horosphere_length} Horosphere saved: \n\t\t {path}")
+
+
+# The generator of a worker process, created once per process by _initialize_worker
+_worker_generator = None
+
+
+def _initialize_worker(commutation_dict, order_dict, ray, compiled_fsm):
+    global _worker_generator
+    _worker_generator = HorosphereGenerator(commutation_dict, order_dict, ray=ray, compiled_fsm=compiled_fsm)
+
+
+def _calculate_shard_adj(words):
+    """Adjacencies of a shard of words, with words converted to strings so they are cheap to send back"""
+    adjacencies = []
+    for word in words:
+        for edge in _worker_generator.calculate_word_adj(word):
+            adjacencies.append(tuple(str(u) for u in edge))
+    return adjacencies
 
 
 # length = 4
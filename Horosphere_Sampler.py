@@ -0,0 +1,133 @@
+import random
+import numpy as np
+
+
+class LevelSampler:
+    def __init__(self, generator, n: int, seed: int = None):
+        """
+        Draws words uniformly at random from level n of the horosphere, i.e. from the words of length n that
+        HorosphereGenerator.iter_words_by_level yields. The number of ways every state can be completed to a word of the
+        remaining length is counted backwards once; a word is then drawn letter by letter, choosing every letter with
+        probability proportional to the number of completions it leaves, which costs O(n) per word.
+
+        :param generator: The HorosphereGenerator of the defining graph.
+        :param n: The length of the sampled words.
+        :param seed: Seed of the random number generators, for reproducible samples.
+        """
+        self.generator = generator
+        self.n = n
+        self.fsm = generator.ray_fsm
+        self.letters = self.fsm.letters
+        self.rows = self.fsm.transitions.tolist()
+        self.random = random.Random(seed)
+        self.rng = np.random.default_rng(seed)
+
+        # Words must not start with the letters in our ray
+        ray_indices = {self.fsm.letter_index[letter] for letter in generator.ray}
+        self.first_letters = [i for i in range(len(self.letters)) if i not in ray_indices]
+
+        # completions[r][state] is the number of words of length r that can be written from state (Python integers)
+        completions = [[1] * len(self.rows)]
+        for _ in range(n):
+            previous = completions[-1]
+            completions.append([
+                sum(previous[destination] for destination in row if destination >= 0) for row in self.rows
+            ])
+        self.completions = completions
+
+        self.level_size = sum(
+            completions[n - 1][self.rows[self.fsm.origin][i]]
+            for i in self.first_letters if self.rows[self.fsm.origin][i] >= 0
+        ) if n > 0 else 1
+        self._cumulative = None
+
+    def __choose(self, state: int, remaining: int, allowed) -> tuple[int, int]:
+        """Choose the next letter from state with remaining letters left to write, weighted by completions"""
+        weights = self.completions[remaining - 1]
+        row = self.rows[state]
+        total = sum(weights[row[i]] for i in allowed if row[i] >= 0)
+        target = self.random.randrange(total)
+        for i in allowed:
+            if row[i] < 0:
+                continue
+            target -= weights[row[i]]
+            if target < 0:
+                return i, row[i]
+        raise RuntimeError("inconsistent completion counts")
+
+    def sample_with_state(self) -> tuple[str, int]:
+        """
+        Draw one word exactly uniformly.
+
+        :return: A (word, state) pair like those of HorosphereGenerator.iter_words_by_level.
+        """
+        if self.level_size == 0:
+            raise ValueError(f"Level {self.n} of the horosphere is empty")
+        all_letters = range(len(self.letters))
+        state = self.fsm.origin
+        word = []
+        for depth in range(self.n):
+            letter, state = self.__choose(state, self.n - depth, self.first_letters if depth == 0 else all_letters)
+            word.append(self.letters[letter])
+        return ''.join(word), state
+
+    def sample(self) -> str:
+        return self.sample_with_state()[0]
+
+    def sample_words(self, size: int) -> list[str]:
+        return [self.sample() for _ in range(size)]
+
+    @property
+    def cumulative(self) -> list[np.ndarray]:
+        """
+        cumulative[r] is a float64 array of shape (states, letters) with the cumulative probabilities of the next
+        letter when r letters are left to write; the first step from the origin excludes the ray letters.
+        """
+        if self._cumulative is None:
+            number_of_letters = len(self.letters)
+            self._cumulative = [None]
+            for remaining in range(1, self.n + 1):
+                weights = self.completions[remaining - 1]
+                probabilities = np.zeros((len(self.rows), number_of_letters))
+                for state, row in enumerate(self.rows):
+                    allowed = self.first_letters if remaining == self.n and state == self.fsm.origin \
+                        else range(number_of_letters)
+                    letter_weights = [weights[row[i]] if i in allowed and row[i] >= 0 else 0
+                                      for i in range(number_of_letters)]
+                    total = sum(letter_weights)
+                    if total:
+                        # Exact integer ratios, rounded once to floats
+                        probabilities[state] = [weight / total for weight in letter_weights]
+                self._cumulative.append(np.cumsum(probabilities, axis=1))
+        return self._cumulative
+
+    def sample_batch(self, size: int, return_states: bool = False):
+        """
+        Draw many words at once with NumPy. Letters are chosen from float64 probabilities, so the distribution is
+        uniform up to floating point rounding; use sample for exactly uniform draws.
+
+        :param size: The number of words to draw.
+        :param return_states: Also return the final FSM state of every word.
+        :return: An int array of shape (size, n) with indices into letters (and an int array of states when return_states).
+        """
+        if self.level_size == 0:
+            raise ValueError(f"Level {self.n} of the horosphere is empty")
+        transitions = np.asarray(self.fsm.transitions)
+        states = np.full(size, self.fsm.origin, dtype=np.int64)
+        words = np.empty((size, self.n), dtype=np.uint8)
+
+        for depth in range(self.n):
+            cumulative = self.cumulative[self.n - depth][states]
+            draws = self.rng.random(size) * cumulative[:, -1]
+            # The first letter whose cumulative probability exceeds the draw; it always has a nonzero probability
+            letters = (draws[:, None] >= cumulative).sum(axis=1)
+            words[:, depth] = letters
+            states = transitions[states, letters]
+
+        if return_states:
+            return words, states
+        return words
+
+    def decode(self, words: np.ndarray) -> list[str]:
+        """Convert rows of letter indices (as returned by sample_batch) to words"""
+        return [''.join(self.letters[i] for i in row) for row in words.tolist()]
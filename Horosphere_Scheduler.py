@@ -0,0 +1,233 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import Horosphere_Generator as horosphere_generator
+from Edge_Store import EdgeWindow
+from Atomic_File import AtomicFile
+
+
+class LevelScheduler:
+    def __init__(self, generator, shard_dir: str, max_workers: int = None, shard_size: int = 50000,
+                 max_retries: int = 1):
+        """
+        Level parallel horosphere generation. An edge of the horosphere joins words of the same length or of lengths
+        differing by one, so the edges found from the words of one level only depend on that level. Levels are split
+        into tasks with explicit dependencies:
+
+            vertices(d)    enumerate level d from the FSM states of level d - 1; run in this process, one transition per word
+            edges(d, k)    the adjacencies of part k of level d; depends on vertices(d), runs in the process pool
+
+        Edge tasks are submitted as soon as their level is enumerated, so the pool works on level d while level d + 1 is
+        being enumerated. Every task writes its own shard file, first under a temporary name and then renamed, so a
+        shard on disk is always complete. Every level also gets a manifest recording its number of words, the shard size
+        and its number of parts. A run keeps the shards of a level whose manifest matches and only writes the missing
+        parts, so running again after a failure only redoes the failed parts; a level whose manifest does not match (or
+        is missing) is invalidated and written from scratch. merge streams the shards into any edge sink and refuses to
+        run while any part listed in a manifest is missing.
+
+        :param generator: The HorosphereGenerator of the defining graph; its compiled FSM is shared with the workers.
+        :param shard_dir: The directory the shards are written to.
+        :param max_workers: Number of worker processes, by default the number of CPUs.
+        :param shard_size: Maximum number of words in one edge task.
+        :param max_retries: How often a failed edge task is resubmitted before it is reported as failed. When a worker process dies (e.g. killed for running out of memory) the pool is replaced and every task that was still pending in it counts as failed once.
+        """
+        self.generator = generator
+        self.shard_dir = shard_dir
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.max_retries = max_retries
+        self.failed = []
+        self.executor = None
+
+    def vertex_shard_path(self, depth: int) -> str:
+        return os.path.join(self.shard_dir, f"level_{depth:03d}_vertices.txt")
+
+    def manifest_path(self, depth: int) -> str:
+        return os.path.join(self.shard_dir, f"level_{depth:03d}_manifest.json")
+
+    def read_manifest(self, depth: int):
+        """:return: The manifest of a level as a dict, or None when it has not been written."""
+        try:
+            with open(self.manifest_path(depth), encoding='utf-8') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def edge_shard_path(self, depth: int, part: int) -> str:
+        return os.path.join(self.shard_dir, f"level_{depth:03d}_part_{part:04d}_edges.tsv")
+
+    def edge_shard_paths(self, depth: int) -> list[str]:
+        prefix = f"level_{depth:03d}_part_"
+        return sorted(
+            os.path.join(self.shard_dir, name) for name in os.listdir(self.shard_dir)
+            if name.startswith(prefix) and name.endswith('_edges.tsv')
+        )
+
+    def run(self, length: int) -> list[tuple[int, int]]:
+        """
+        Compute the shards of the horosphere of the given length.
+
+        :param length: Length of the longest ShortLex word.
+        :return: The (level, part) edge tasks that failed after all retries; empty on success.
+        """
+        os.makedirs(self.shard_dir, exist_ok=True)
+        generator = self.generator
+        self.failed = []
+        futures = {}
+
+        self.executor = self.__start_executor()
+        try:
+            for depth, level in enumerate(generator.iter_words_by_level(length)):
+                level = list(level)
+                manifest = {
+                    'words': len(level),
+                    'shard_size': self.shard_size,
+                    'parts': len(range(0, max(len(level), 1), self.shard_size))
+                }
+                if self.read_manifest(depth) != manifest:
+                    self.__invalidate_level(depth)
+                    self.__write_vertex_shard(depth, level)
+                    self.__write_manifest(depth, manifest)
+                else:
+                    self.__write_vertex_shard(depth, level)
+
+                for part, start in enumerate(range(0, max(len(level), 1), self.shard_size)):
+                    path = self.edge_shard_path(depth, part)
+                    if os.path.exists(path):
+                        continue
+                    task = (level[start:start + self.shard_size], path)
+                    futures[(depth, part)] = (task, self.__submit(task), 0)
+
+            # Collect in (level, part) order; failed tasks are resubmitted on their own. A dead worker breaks the pool and
+            # fails all its pending tasks, which are then resubmitted to a new pool
+            while futures:
+                for key in sorted(futures):
+                    task, future, attempts = futures.pop(key)
+                    try:
+                        future.result()
+                    except Exception as error:
+                        if attempts < self.max_retries:
+                            futures[key] = (task, self.__submit(task), attempts + 1)
+                        else:
+                            print(f"Level {key[0]} part {key[1]} failed: \n\t\t {error!r}")
+                            self.failed.append(key)
+        finally:
+            self.executor.shutdown()
+            self.executor = None
+
+        print(f"Length {length} Horosphere shards written: \n\t\t {self.shard_dir}")
+        return self.failed
+
+    def __start_executor(self) -> ProcessPoolExecutor:
+        generator = self.generator
+        return ProcessPoolExecutor(max_workers=self.max_workers, initializer=horosphere_generator._initialize_worker,
+                                   initargs=(generator.c_map, generator.o_map, generator.ray, generator.compiled_fsm))
+
+    def __submit(self, task: tuple):
+        """Submit an edge task, replacing the pool first when a dead worker has broken it"""
+        try:
+            return self.executor.submit(_write_edge_shard, *task)
+        except BrokenProcessPool:
+            self.executor.shutdown()
+            self.executor = self.__start_executor()
+            return self.executor.submit(_write_edge_shard, *task)
+
+    def __invalidate_level(self, depth: int):
+        """Remove the manifest and every shard of a level; the manifest goes first, so a level is never half valid"""
+        for path in [self.manifest_path(depth), self.vertex_shard_path(depth), *self.edge_shard_paths(depth)]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def __write_manifest(self, depth: int, manifest: dict):
+        path = self.manifest_path(depth)
+        with AtomicFile(path, 'w', encoding='utf-8') as file:
+            json.dump(manifest, file)
+
+    def __write_vertex_shard(self, depth: int, level: list):
+        path = self.vertex_shard_path(depth)
+        if os.path.exists(path):
+            return
+        with AtomicFile(path, 'w', encoding='utf-8') as file:
+            for word, _ in level:
+                file.write(f"{self.generator.vertex_name(word)}\n")
+
+    def iter_vertices(self, depth: int):
+        """The prefixed vertex names of one level, read back from its shard"""
+        with open(self.vertex_shard_path(depth), encoding='utf-8') as file:
+            for line in file:
+                yield line[:-1]
+
+    def missing_parts(self, length: int) -> list[tuple[int, int]]:
+        """
+        The edge shards that the manifests expect but that are not on disk.
+
+        :param length: Length of the longest ShortLex word, as passed to run.
+        :return: The missing (level, part) pairs; a level without a manifest counts as its part 0 missing.
+        """
+        missing = []
+        for depth in range(length + 1):
+            manifest = self.read_manifest(depth)
+            if manifest is None:
+                missing.append((depth, 0))
+                continue
+            missing.extend(
+                (depth, part) for part in range(manifest['parts'])
+                if not os.path.exists(self.edge_shard_path(depth, part))
+            )
+        return missing
+
+    def iter_edges(self, length: int):
+        """
+        Stream the edges of all shards in level order, every undirected edge once. Like
+        HorosphereGenerator.iter_horosphere_edges, only the edges that can still come up again (those whose longer word
+        is longer than the current level) are kept for deduplication.
+
+        :param length: Length of the longest ShortLex word, as passed to run.
+        :return: A generator of (u, v) vertex name pairs.
+        """
+        missing = self.missing_parts(length)
+        if missing:
+            raise RuntimeError(
+                f"Levels {sorted({depth for depth, _ in missing})} are missing edge shards; run again to redo them"
+            )
+
+        window = EdgeWindow()
+
+        for depth in range(length + 1):
+            for part in range(self.read_manifest(depth)['parts']):
+                with open(self.edge_shard_path(depth, part), encoding='utf-8') as file:
+                    for line in file:
+                        edge = window.add_edge(*line[:-1].split('\t'))
+                        if edge is not None:
+                            yield edge
+
+            # Names carry the ray prefix, so a word of length d has a name of length 2d
+            window.forget(2 * depth)
+
+    def merge(self, length: int, sink) -> int:
+        """
+        Merge the shards into a sink.
+
+        :param length: Length of the longest ShortLex word, as passed to run.
+        :param sink: Any object with an add_edge(u, v) method, e.g. a networkx.Graph or a Horosphere_Writers.GraphMLWriter.
+        :return: The number of edges written.
+        """
+        number_of_edges = 0
+        for u, v in self.iter_edges(length):
+            sink.add_edge(u, v)
+            number_of_edges += 1
+        return number_of_edges
+
+
+def _write_edge_shard(level: list, path: str):
+    """Edge task: write the edges found from one part of a level, canonically ordered and deduplicated"""
+    generator = horosphere_generator._worker_generator
+
+    window = EdgeWindow()
+    with AtomicFile(path, 'w', encoding='utf-8') as file:
+        for word, state in level:
+            for u, v in generator.calculate_word_adj(word, state):
+                edge = window.add_edge(str(u), str(v))
+                if edge is not None:
+                    file.write(f"{generator.vertex_name(edge[0])}\t{generator.vertex_name(edge[1])}\n")
@@ -0,0 +1,105 @@
+from xml.sax.saxutils import quoteattr
+from Atomic_File import AtomicFile
+
+
+class EdgeListWriter:
+    def __init__(self, path: str, delimiter: str = '\t'):
+        """
+        An edge sink that streams every edge to a text file, one "u<delimiter>v" line per edge, instead of keeping the
+        graph in memory. Any object with an add_edge(u, v) method (e.g. a networkx.Graph) can be used as a sink in its
+        place. The file is written under a temporary name and only renamed to path once it is closed without an error, so
+        an interrupted run never leaves a truncated file behind or replaces an earlier one.
+
+        :param path: The file the edge list is written to.
+        :param delimiter: The string separating the two vertices of an edge. The empty word is a vertex, so it must not be whitespace that a reader would collapse.
+        """
+        self.path = path
+        self.atomic_file = AtomicFile(path, 'w', encoding='utf-8')
+        self.delimiter = delimiter
+        self.file = None
+        self.number_of_edges = 0
+
+    def __enter__(self):
+        self.file = self.atomic_file.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_edge(self, u: str, v: str):
+        self.file.write(f"{u}{self.delimiter}{v}\n")
+        self.number_of_edges += 1
+
+    def close(self):
+        """Finish the file and move it to path"""
+        self.atomic_file.commit()
+        self.file = None
+
+    def abort(self):
+        """Discard the partially written file, leaving path untouched"""
+        self.atomic_file.discard()
+        self.file = None
+
+
+class GraphMLWriter:
+    def __init__(self, path: str, compress: bool = None):
+        """
+        An edge sink that writes GraphML incrementally: every edge is written as soon as it arrives, preceded by node
+        elements for endpoints that have not been written yet. The output has the same layout as the files written by
+        networkx.write_graphml_lxml (an undirected graph without attributes), so it loads into the same tools. Only the
+        ids of the written nodes are kept in memory. Like EdgeListWriter, the file is written under a temporary name and
+        only renamed to path (footer included) once it is closed without an error.
+
+        :param path: The file the GraphML is written to.
+        :param compress: Whether to gzip the output; by default the output is compressed when path ends with ".gz".
+        """
+        self.path = path
+        self.compress = path.endswith('.gz') if compress is None else compress
+        self.atomic_file = AtomicFile(path, 'w', encoding='utf-8', compress=self.compress)
+        self.file = None
+        self.written_nodes = set()
+        self.number_of_edges = 0
+
+    def __enter__(self):
+        self.file = self.atomic_file.open()
+        self.file.write(
+            "<?xml version='1.0' encoding='utf-8'?>\n"
+            '<graphml xmlns="http://graphml.graphdrawing.org/xmlns" '
+            'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+            'xsi:schemaLocation="http://graphml.graphdrawing.org/xmlns '
+            'http://graphml.graphdrawing.org/xmlns/1.0/graphml.xsd">\n'
+            '  <graph edgedefault="undirected">\n'
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add_node(self, u: str):
+        if u not in self.written_nodes:
+            self.written_nodes.add(u)
+            self.file.write(f"    <node id={quoteattr(u)} />\n")
+
+    def add_edge(self, u: str, v: str):
+        self.add_node(u)
+        self.add_node(v)
+        self.file.write(f"    <edge source={quoteattr(u)} target={quoteattr(v)} />\n")
+        self.number_of_edges += 1
+
+    def close(self):
+        """Write the footer and move the finished file to path"""
+        if self.file is not None:
+            self.file.write("  </graph>\n</graphml>\n")
+        self.atomic_file.commit()
+        self.file = None
+
+    def abort(self):
+        """Discard the partially written file without a footer, leaving path untouched"""
+        self.atomic_file.discard()
+        self.file = None
@@ -0,0 +1,87 @@
+import sys
+from collections import OrderedDict
+
+# Approximate bytes an entry costs besides its key: the ordered dictionary slot and link plus the state integer
+ENTRY_OVERHEAD = 112
+
+
+class StateCache:
+    def __init__(self, max_bytes: int = 32 * 2 ** 20):
+        """
+        An in-memory map from words to FSM states, bounded by an approximate byte budget. When the budget is exceeded
+        the least recently used words are evicted first. Hits and misses are counted so the budget can be tuned per
+        defining graph.
+
+        :param max_bytes: Upper bound on the approximate size of the cached entries; 0 disables caching.
+        """
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def entry_size(word: str) -> int:
+        return sys.getsizeof(word) + ENTRY_OVERHEAD
+
+    def get(self, word: str):
+        """
+        Look up a word and mark it as recently used.
+
+        :return: The cached state, or None on a miss.
+        """
+        state = self.entries.get(word)
+        if state is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(word)
+        return state
+
+    def peek(self, word: str):
+        """Look up a word without counting the lookup or changing its recency"""
+        return self.entries.get(word)
+
+    def put(self, word: str, state: int):
+        if word in self.entries:
+            self.entries[word] = state
+            self.entries.move_to_end(word)
+            return
+
+        size = self.entry_size(word)
+        if size > self.max_bytes:
+            return
+        self.entries[word] = state
+        self.size += size
+
+        while self.size > self.max_bytes:
+            evicted_word, _ = self.entries.popitem(last=False)
+            self.size -= self.entry_size(evicted_word)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.entries
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate
+        }
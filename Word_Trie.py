@@ -0,0 +1,109 @@
+import numpy as np
+
+# Letter index of the root, which stands for the empty word
+ROOT_LETTER = 255
+
+
+class WordTrie:
+    def __init__(self, letters: list[str], letter: np.ndarray, state: np.ndarray, parent: np.ndarray,
+                 depth: np.ndarray):
+        """
+        A prefix trie of enumerated short-lex words in array form. Node i stands for the word spelled by the letters on
+        the path from the root (node 0, the empty word) to i, and stores its last letter, its FSM state and its parent.
+        Nodes are numbered in BFS order, so every level is a contiguous range of ids and the parent array is sorted,
+        which makes the children of a node a contiguous range as well.
+
+        :param letters: The alphabet; letter holds indices into this list.
+        :param letter: uint8 array, the last letter of every node (ROOT_LETTER for the root).
+        :param state: int32 array, the FSM state of every node.
+        :param parent: int32 array, the parent of every node (-1 for the root).
+        :param depth: uint16 array, the length of the word of every node.
+        """
+        self.letters = list(letters)
+        self.letter_index = {letter: i for i, letter in enumerate(self.letters)}
+        self.letter = letter
+        self.state = state
+        self.parent = parent
+        self.depth = depth
+        # level_offsets[d] is the first node of depth d
+        self.level_offsets = np.searchsorted(depth, np.arange(int(depth[-1]) + 2)).astype(np.int64)
+
+    @property
+    def max_depth(self) -> int:
+        return len(self.level_offsets) - 2
+
+    def __len__(self):
+        return len(self.letter)
+
+    @property
+    def nbytes(self) -> int:
+        return self.letter.nbytes + self.state.nbytes + self.parent.nbytes + self.depth.nbytes
+
+    def level(self, depth: int) -> range:
+        """The ids of the nodes whose words have the given length"""
+        if depth > self.max_depth:
+            return range(0)
+        return range(int(self.level_offsets[depth]), int(self.level_offsets[depth + 1]))
+
+    def level_size(self, depth: int) -> int:
+        return len(self.level(depth))
+
+    def children(self, node: int) -> range:
+        return range(int(np.searchsorted(self.parent, node, 'left')), int(np.searchsorted(self.parent, node, 'right')))
+
+    def word(self, node: int) -> str:
+        """Spell the word of a node by walking up to the root"""
+        letters = []
+        while node > 0:
+            letters.append(self.letters[self.letter[node]])
+            node = self.parent[node]
+        return ''.join(reversed(letters))
+
+    def find(self, word) -> int:
+        """
+        Walk down the trie along word.
+
+        :return: The node of word, or -1 when word is not in the trie.
+        """
+        node = 0
+        for letter in word:
+            if letter not in self.letter_index:
+                return -1
+            children = self.children(node)
+            # A node has at most one child per letter of the alphabet
+            matches = np.flatnonzero(self.letter[children.start:children.stop] == self.letter_index[letter])
+            if len(matches) == 0:
+                return -1
+            node = children.start + int(matches[0])
+        return node
+
+    def __contains__(self, word) -> bool:
+        return self.find(word) >= 0
+
+    def iter_levels(self):
+        """
+        :return: A generator yielding, for every length, the list of (word, state) pairs of that length in BFS order, the same as HorosphereGenerator.iter_words_by_level.
+        """
+        # Words are built from the words of the previous level, so only two levels of strings exist at a time
+        words = ['']
+        for depth in range(self.max_depth + 1):
+            level = self.level(depth)
+            if depth > 0:
+                start = self.level_offsets[depth - 1]
+                parents = (self.parent[level.start:level.stop] - start).tolist()
+                letters = self.letter[level.start:level.stop].tolist()
+                words = [words[p] + self.letters[x] for p, x in zip(parents, letters)]
+            yield list(zip(words, self.state[level.start:level.stop].tolist()))
+
+    def iter_level(self, depth: int):
+        """:return: A generator of the (word, state) pairs of the given length in BFS order."""
+        for level_depth, level in enumerate(self.iter_levels()):
+            if level_depth == depth:
+                yield from level
+                return
+
+    def __iter__(self):
+        """Iterate over all words, shortest first"""
+        for level in self.iter_levels():
+            for word, _ in level:
+                yield word
@@ -1,4 +1,4 @@
-from FSM_Generator import FSMGenerator
+from FSM_Cache import FSMCache
 from Horosphere_Generator import HorosphereGenerator
 from Defining_Graphs import DefiningGraphs as DG
 
@@ -58,8 +58,8 @@ if __name__ == '__main__':
     c_map = DG.torus_c_map
     o_map = DG.torus_o_map
 
-    FSM_Gen = FSMGenerator(c_map, o_map)
-    Horo_Gen = HorosphereGenerator(c_map, o_map, ray=['a', 'c'])
+    # The compiled machines are cached per defining graph, so only the first run for a graph builds them
+    Horo_Gen = HorosphereGenerator(c_map, o_map, ray=['a', 'c'], cache=FSMCache())
     # G = Horo_Gen.horosphere_as_networkx(length)
     # Horo_Gen.visualize_horosphere(G)
     Horo_Gen.save_horosphere_as_graphml(horosphere_length=length, horosphere_type=horosphere_type)
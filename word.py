@@ -1,18 +1,225 @@
+import heapq
 from _collections_abc import Sequence, Iterable
 from abc import ABC
 
 
+class BitmaskAlphabet:
+    def __init__(self, commutation_dict: dict[str: list], order_dict: dict[str: int]):
+        """
+        Integer bitmask representation of a defining graph. Every letter is assigned an index given by its position in
+        the total ordering, and every commutation neighborhood is precomputed as an integer bitmask. Sets of letters are
+        then plain integers, so last-letter, forbidden-letter and legal-next-letter sets can be computed with a single
+        iterative pass of AND/OR operations.
+
+        :param commutation_dict: A dictionary representation of a defining graph. A letter (key) is associated with a list of letters (value) in the dictionary such that all letters in the list commute with the key.
+        :param order_dict: A dictionary representation of a total ordering on the letter in the defining graph. A letter (key) is associated with an index (value) that represents that letters relative position in the ordering.
+        """
+        self.c_map = commutation_dict
+        self.o_map = order_dict
+
+        # Letters sorted by the total ordering; a letter's position in this list is its bit index
+        self.letters = sorted(order_dict, key=lambda letter: order_dict[letter])
+        self.index = {letter: i for i, letter in enumerate(self.letters)}
+        self.bit = {letter: 1 << i for i, letter in enumerate(self.letters)}
+        self.full_mask = (1 << len(self.letters)) - 1
+        # Frozen, since every word of the defining graph shares this set as its alphabet
+        self.alphabet = frozenset(self.letters)
+
+        # N(x): all letters that commute with x
+        self.neighborhood = {letter: self.mask(commutation_dict[letter]) for letter in self.letters}
+
+        # Letters forbidden after the single letter word x: x itself and every neighbor of x that is smaller than x
+        self.first_forbidden = {
+            letter: self.bit[letter] | self.mask(
+                neighbor for neighbor in commutation_dict[letter] if order_dict[neighbor] < order_dict[letter]
+            )
+            for letter in self.letters
+        }
+
+        # Indices of the letters that do not commute with the letter of each index, the letter itself included
+        self.blocking_indices = [
+            [j for j in range(len(self.letters)) if not self.neighborhood[letter] >> j & 1] for letter in self.letters
+        ]
+
+    def mask(self, letters) -> int:
+        """Convert an iterable of letters to its bitmask"""
+        mask = 0
+        for letter in letters:
+            mask |= self.bit[letter]
+        return mask
+
+    def letters_of(self, mask: int) -> set:
+        """Convert a bitmask to the set of letters it contains"""
+        letters = set()
+        while mask:
+            # Isolate and clear the lowest set bit
+            low_bit = mask & -mask
+            letters.add(self.letters[low_bit.bit_length() - 1])
+            mask ^= low_bit
+        return letters
+
+    def string_of(self, mask: int) -> str:
+        """Convert a bitmask to the sorted string of letters used to label FSM states"""
+        return ''.join(sorted(self.letters_of(mask)))
+
+    def last_letters_step(self, last_mask: int, letter: str) -> int:
+        """Last letters of wx given the last letters of w: {x} union (L(w) intersect N(x))"""
+        return self.bit[letter] | (last_mask & self.neighborhood[letter])
+
+    def forbidden_letters_step(self, forbidden_mask: int, letter: str) -> int:
+        """Forbidden letters of wx given the forbidden letters of w: F({x}) union (F(w) intersect N(x))"""
+        return self.first_forbidden[letter] | (forbidden_mask & self.neighborhood[letter])
+
+    def legal_next_letters_step(self, legal_mask: int, letter: str) -> int:
+        """Legal next letters of wx given the legal next letters of w"""
+        return self.full_mask & ~self.forbidden_letters_step(self.full_mask & ~legal_mask, letter)
+
+    def last_letters_mask(self, word) -> int:
+        """Bitmask of the letters that can be commuted to the end of word"""
+        last_mask = 0
+        for letter in word:
+            last_mask = self.bit[letter] | (last_mask & self.neighborhood[letter])
+        return last_mask
+
+    def forbidden_letters_mask(self, word) -> int:
+        """Bitmask of the letters that cannot be appended to the short-lex word while keeping it short-lex"""
+        forbidden_mask = 0
+        for letter in word:
+            forbidden_mask = self.first_forbidden[letter] | (forbidden_mask & self.neighborhood[letter])
+        return forbidden_mask
+
+    def legal_next_letters_mask(self, word) -> int:
+        """Bitmask of the letters that can be appended to the short-lex word while keeping it short-lex"""
+        return self.full_mask & ~self.forbidden_letters_mask(word)
+
+    def normal_form(self, word) -> list[str]:
+        """
+        The short-lex normal form of the group element spelled by an arbitrary word. Every letter is an involution, so
+        two occurrences of a letter cancel when every letter between them commutes with it.
+
+        The word is reduced with one pile per letter holding the positions of the kept occurrences that do not commute
+        with it (its own occurrences included): a new letter cancels exactly when the top of its pile is an occurrence of
+        itself. Cancelled occurrences are left in the other piles and skipped once they come to the top, so reducing
+        costs O(n * deg) where deg bounds the number of letters not commuting with a letter. The reduced word is then
+        rearranged into the least linear extension of its heap (occurrences of non-commuting letters keep their order)
+        by always writing the smallest letter that has nothing left in front of it.
+
+        :param word: An iterable of letters.
+        :return: The short-lex normal form as a list of letters.
+        """
+        index = self.index
+        blocking = self.blocking_indices
+        piles = [[] for _ in self.letters]
+        letters = []
+        deleted = []
+
+        for letter in word:
+            x = index[letter]
+            pile = piles[x]
+            while pile and deleted[pile[-1]]:
+                pile.pop()
+            if pile and letters[pile[-1]] == x:
+                # Every kept letter after the top of the pile commutes with x, so x cancels it
+                deleted[pile.pop()] = True
+                continue
+            position = len(letters)
+            letters.append(x)
+            deleted.append(False)
+            for y in blocking[x]:
+                piles[y].append(position)
+
+        # Heap order: a kept occurrence comes after the last earlier occurrence of every letter blocking it
+        last_position = [-1] * len(self.letters)
+        successors = [[] for _ in letters]
+        predecessors = [0] * len(letters)
+        for position, x in enumerate(letters):
+            if deleted[position]:
+                continue
+            for y in blocking[x]:
+                if last_position[y] >= 0:
+                    successors[last_position[y]].append(position)
+                    predecessors[position] += 1
+            last_position[x] = position
+
+        # Letter indices follow the total ordering, so the smallest available index is the short-lex choice
+        available = [(x, position) for position, x in enumerate(letters)
+                     if not deleted[position] and predecessors[position] == 0]
+        heapq.heapify(available)
+        normal_form = []
+        while available:
+            x, position = heapq.heappop(available)
+            normal_form.append(self.letters[x])
+            for successor in successors[position]:
+                predecessors[successor] -= 1
+                if predecessors[successor] == 0:
+                    heapq.heappush(available, (letters[successor], successor))
+
+        return normal_form
+
+
+# Bitmask alphabets shared by every word of a defining graph: by identity of the dictionaries for the common case of
+# words built from the same c_map/o_map objects, and by the canonicalized defining graph otherwise
+_alphabets_by_identity = {}
+_alphabets_by_graph = {}
+IDENTITY_CACHE_SIZE = 64
+
+
+def shared_bitmask_alphabet(commutation_dict: dict[str: list], order_dict: dict[str: int]) -> BitmaskAlphabet:
+    """
+    The BitmaskAlphabet of a defining graph, built once per graph and reused afterwards. Defining graphs are not
+    expected to change once words have been built from them.
+
+    :param commutation_dict: A dictionary representation of a defining graph.
+    :param order_dict: A dictionary representation of a total ordering on the letter in the defining graph.
+    :return: The shared BitmaskAlphabet.
+    """
+    entry = _alphabets_by_identity.get((id(commutation_dict), id(order_dict)))
+    # The dictionaries are kept in the entry, so their ids cannot be reused while it exists
+    if entry is not None and entry[0] is commutation_dict and entry[1] is order_dict:
+        return entry[2]
+
+    key = (
+        tuple(sorted((letter, tuple(sorted(neighbors))) for letter, neighbors in commutation_dict.items())),
+        tuple(sorted(order_dict.items()))
+    )
+    letter_masks = _alphabets_by_graph.get(key)
+    if letter_masks is None:
+        letter_masks = _alphabets_by_graph[key] = BitmaskAlphabet(commutation_dict, order_dict)
+    # Callers that build new dictionaries for every word would otherwise grow the identity cache without bound
+    if len(_alphabets_by_identity) >= IDENTITY_CACHE_SIZE:
+        _alphabets_by_identity.clear()
+    _alphabets_by_identity[(id(commutation_dict), id(order_dict))] = (commutation_dict, order_dict, letter_masks)
+    return letter_masks
+
+
 class WordGenerator:
     def __init__(self, commutation_dict: dict[str: list], order_dict: dict[str: int]):
         self.c_map = commutation_dict
         self.o_map = order_dict
+        self.letter_masks = shared_bitmask_alphabet(self.c_map, self.o_map)
 
     def word(self, word):
-        return Word(word, self.c_map, self.o_map)
+        return Word(word, self.c_map, self.o_map, self.letter_masks)
+
+    def state_word(self, word):
+        return StateWord(word, self.c_map, self.o_map, self.letter_masks)
+
+    def normal_form(self, word) -> str:
+        """The short-lex normal form of the group element spelled by an arbitrary word (see BitmaskAlphabet.normal_form)"""
+        return ''.join(self.letter_masks.normal_form(word))
+
+    def equal_elements(self, u, v) -> bool:
+        """Whether two arbitrary words spell the same group element"""
+        return self.normal_form(u) == self.normal_form(v)
+
+    def element_hash(self, word) -> int:
+        """A hash of the group element spelled by a word; words spelling the same element hash alike"""
+        return hash(self.normal_form(word))
 
 
 class Word(Sequence):
-    def __init__(self, word, commutation_dict: dict[str: list], order_dict: dict[str: int]):
+    def __init__(self, word, commutation_dict: dict[str: list], order_dict: dict[str: int],
+                 letter_masks: BitmaskAlphabet = None):
         if word is list:
             self.word_as_list = word
         elif isinstance(word, Iterable):
@@ -21,9 +228,16 @@ class Word(Sequence):
             raise TypeError("argument 'word' is not iterable")
         self.c_map = commutation_dict
         self.o_map = order_dict
-        self.alphabet = set().union(letter for letter in order_dict)
+        # A frozen letter set shared with the bitmask alphabet of the defining graph, which is built once per graph
+        self._letter_masks = letter_masks if letter_masks is not None else \
+            shared_bitmask_alphabet(commutation_dict, order_dict)
+        self.alphabet = self._letter_masks.alphabet
         # super.__init__()
 
+    @property
+    def letter_masks(self) -> BitmaskAlphabet:
+        return self._letter_masks
+
     def __getitem__(self, item):
         return self.word_as_list[item]
 
@@ -35,7 +249,7 @@ class Word(Sequence):
 
     def copy(self):
         copy_word_list = list(letter for letter in self.word_as_list)
-        return Word(copy_word_list, self.c_map, self.o_map)
+        return Word(copy_word_list, self.c_map, self.o_map, self._letter_masks)
 
     def append(self, value: str) -> None:
         self.word_as_list.append(value)
@@ -54,32 +268,226 @@ class Word(Sequence):
         self.word_as_list.insert(index, value)
         return self
 
-    def __last_letter_recursive(self, w_list) -> set:
-        if len(w_list) <= 1:
-            return set(w_list)
+    def normal_form(self):
+        """
+        Reduce the word, cancelling letters where the commutation relations allow it, and rearrange it into short-lex
+        order.
+
+        :return: A new Word holding the short-lex normal form of the group element spelled by this word.
+        """
+        return Word(self.letter_masks.normal_form(self), self.c_map, self.o_map, self.letter_masks)
 
-        return self.__last_letter_recursive(w_list[:-1]) \
-            .intersection(self.c_map[w_list[-1]])          \
-            .union(set(w_list[-1]))
+    def equals_element(self, other) -> bool:
+        """Whether this word and another word (or iterable of letters) spell the same group element"""
+        return self.letter_masks.normal_form(self) == self.letter_masks.normal_form(other)
+
+    def element_hash(self) -> int:
+        """A hash of the group element spelled by this word; words spelling the same element hash alike"""
+        return hash(''.join(self.letter_masks.normal_form(self)))
 
     def last_letters(self) -> set:
-        return self.__last_letter_recursive(self.word_as_list)
+        return self.letter_masks.letters_of(self.letter_masks.last_letters_mask(self.word_as_list))
+
+    def forbidden_letters(self) -> set:
+        return self.letter_masks.letters_of(self.letter_masks.forbidden_letters_mask(self.word_as_list))
+
+    def legal_next_letters(self) -> set:
+        return self.letter_masks.letters_of(self.letter_masks.legal_next_letters_mask(self.word_as_list))
 
-    def __neighborhood(self, letter: str) -> set:
-        return set(self.c_map[letter])
 
-    def __forbidden_letters_recursive(self, w_list) -> set:
-        if len(w_list) == 1:
-            return set(
-                filter(lambda x: self.o_map[x] < self.o_map[w_list[0]], self.__neighborhood(w_list[0]))
-            ).union(set(w_list[0]))
+class _WordNode:
+    """
+    A single letter appended to a parent node, together with the masks of the word spelled by the path from the root to
+    this node. Nodes are never mutated, so any number of words can share a common prefix.
+    """
+    __slots__ = ('parent', 'letter', 'length', 'forbidden', 'last', 'commuting')
 
-        return self.__forbidden_letters_recursive(w_list[-1])\
-            .union(self.__forbidden_letters_recursive(w_list[:-1]))\
-            .intersection(self.__neighborhood(w_list[-1]))
+    def __init__(self, parent, letter, length: int, forbidden: int, last: int, commuting: int):
+        self.parent = parent
+        self.letter = letter
+        self.length = length
+        self.forbidden = forbidden
+        self.last = last
+        self.commuting = commuting
+
+    def child(self, letter: str, letter_masks: BitmaskAlphabet):
+        neighborhood = letter_masks.neighborhood[letter]
+        return _WordNode(
+            self, letter, self.length + 1,
+            letter_masks.first_forbidden[letter] | (self.forbidden & neighborhood),
+            letter_masks.bit[letter] | (self.last & neighborhood),
+            self.commuting & neighborhood
+        )
+
+
+class StateWord(Word):
+    def __init__(self, word, commutation_dict: dict[str: list], order_dict: dict[str: int],
+                 letter_masks: BitmaskAlphabet = None):
+        """
+        A Word that carries its fiber product state (forbidden, last and commuting letter masks) and updates it
+        incrementally. Letters are stored as a chain of immutable nodes, so append, shortlex_append and insert(0, ...)
+        only create the nodes they need while copies share all of their structure with the original.
+
+        Letters inserted at the front are kept apart from the chain together with their own masks. The masks of the whole
+        word combine both parts: a letter of the front part still counts if it commutes with every letter of the chain.
+
+        :param word: An iterable of letters.
+        :param commutation_dict: A dictionary representation of a defining graph. A letter (key) is associated with a list of letters (value) in the dictionary such that all letters in the list commute with the key.
+        :param order_dict: A dictionary representation of a total ordering on the letter in the defining graph. A letter (key) is associated with an index (value) that represents that letters relative position in the ordering.
+        :param letter_masks: The bitmask alphabet of the defining graph, shared between words when given.
+        """
+        if not isinstance(word, Iterable):
+            raise TypeError("argument 'word' is not iterable")
+        self.c_map = commutation_dict
+        self.o_map = order_dict
+        self._letter_masks = letter_masks if letter_masks is not None else \
+            shared_bitmask_alphabet(self.c_map, self.o_map)
+        self.alphabet = self._letter_masks.alphabet
+        self._clear()
+        for letter in word:
+            self.append(letter)
+
+    def _clear(self):
+        self._node = _WordNode(None, None, 0, 0, 0, self._letter_masks.full_mask)
+        self._front = ''
+        self._front_forbidden = 0
+        self._front_last = 0
+        self._front_commuting = self._letter_masks.full_mask
+
+    def _rebuild(self, letters):
+        self._clear()
+        for letter in letters:
+            self.append(letter)
+
+    @property
+    def word_as_list(self) -> list:
+        chain = []
+        node = self._node
+        while node.parent is not None:
+            chain.append(node.letter)
+            node = node.parent
+        chain.reverse()
+        return list(self._front) + chain
+
+    def __getitem__(self, item):
+        return self.word_as_list[item]
+
+    def __iter__(self):
+        return iter(self.word_as_list)
+
+    def __len__(self):
+        return len(self._front) + self._node.length
+
+    def copy(self):
+        copy_word = StateWord.__new__(StateWord)
+        copy_word.__dict__.update(self.__dict__)
+        return copy_word
+
+    def append(self, value: str) -> None:
+        self._node = self._node.child(value, self._letter_masks)
+
+    def shortlex_append(self, value: str):
+        masks = self._letter_masks
+        node = self._node
+        # Letters we move past, the last letter of the word first
+        tail = []
+        skip = 0
+        while node.parent is not None:
+            if not masks.neighborhood[value] & masks.bit[node.letter]:
+                break
+            tail.append(node.letter)
+            if self.o_map[node.letter] > self.o_map[value]:
+                skip = len(tail)
+            node = node.parent
+        else:
+            if self._front:
+                # The value commutes with the whole chain and may move into the front letters
+                self._rebuild(Word(self.word_as_list, self.c_map, self.o_map).shortlex_append(value))
+                return self
+
+        # Branch off the node before the optimal insertion point and re-append the letters we moved past
+        node = self._node
+        for _ in range(skip):
+            node = node.parent
+        node = node.child(value, masks)
+        for letter in reversed(tail[:skip]):
+            node = node.child(letter, masks)
+        self._node = node
+        return self
+
+    def insert(self, index: int, value: str):
+        if index != 0:
+            letters = self.word_as_list
+            letters.insert(index, value)
+            self._rebuild(letters)
+            return self
+
+        # Only the masks of the front letters change, the chain is left untouched
+        masks = self._letter_masks
+        self._front_forbidden |= masks.first_forbidden[value] & self._front_commuting
+        self._front_last |= masks.bit[value] & self._front_commuting
+        self._front_commuting &= masks.neighborhood[value]
+        self._front = value + self._front
+        return self
+
+    def delete_last_occurrence(self, value: str):
+        """
+        Remove the right-most occurrence of value from the word. Only the letters after the removed one are re-appended.
+
+        :param value: The letter to remove, typically one of the last letters of the word.
+        :return: self
+        """
+        masks = self._letter_masks
+        node = self._node
+        tail = []
+        while node.parent is not None:
+            if node.letter == value:
+                node = node.parent
+                for letter in reversed(tail):
+                    node = node.child(letter, masks)
+                self._node = node
+                return self
+            tail.append(node.letter)
+            node = node.parent
+
+        letters = self.word_as_list
+        if value not in letters:
+            raise ValueError(f"{value!r} is not in word")
+        del letters[len(letters) - 1 - letters[::-1].index(value)]
+        self._rebuild(letters)
+        return self
+
+    @property
+    def forbidden_letters_mask(self) -> int:
+        return self._node.forbidden | (self._front_forbidden & self._node.commuting)
+
+    @property
+    def last_letters_mask(self) -> int:
+        return self._node.last | (self._front_last & self._node.commuting)
+
+    @property
+    def legal_next_letters_mask(self) -> int:
+        return self._letter_masks.full_mask & ~self.forbidden_letters_mask
+
+    @property
+    def commuting_letters_mask(self) -> int:
+        """Bitmask of the letters that commute with every letter of the word"""
+        return self._front_commuting & self._node.commuting
+
+    def last_letters(self) -> set:
+        return self._letter_masks.letters_of(self.last_letters_mask)
 
     def forbidden_letters(self) -> set:
-        return self.__forbidden_letters_recursive(self.word_as_list)
+        return self._letter_masks.letters_of(self.forbidden_letters_mask)
 
     def legal_next_letters(self) -> set:
-        return self.alphabet.copy().difference(self.forbidden_letters())
+        return self._letter_masks.letters_of(self.legal_next_letters_mask)
+
+    def state(self) -> tuple[str, str]:
+        """
+        The fiber product FSM state of the word in the same form as FSMGenerator.locate_associated_state.
+
+        :return: A fiber product FSM state (A, B) where A denotes the letters that can be written while keeping the word short-lex and B denotes the letters that can be commuted to be last in the word.
+        """
+        return self._letter_masks.string_of(self.legal_next_letters_mask), \
+            self._letter_masks.string_of(self.last_letters_mask)